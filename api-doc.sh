@@ -70,27 +70,40 @@ python_docstrings() {
     echo ""
     doc press
     doc wait_for_match
+    doc wait_for_any_match
     doc press_until_match
     doc wait_for_motion
+    doc wait_for_stable
     doc detect_match
+    doc detect_matches
     doc detect_motion
+    doc detect_motion_regions
     doc ocr
+    doc ocr_many
     doc OcrMode
     doc as_precondition
     doc frames
     doc save_frame
     doc get_frame
+    doc frame_statistics
+    doc save_flight_recording
     doc is_screen_black
     doc draw_text
     doc get_config
     doc debug
     doc MatchParameters
+    doc Template
     doc MatchResult
     doc Position
     doc Region
     doc MotionResult
+    doc MotionRegionsResult
+    doc RegionMotion
+    doc StableResult
+    doc FrameStatistics
     doc MatchTimeout
     doc MotionTimeout
+    doc StableTimeout
     doc NoVideo
     doc PreconditionError
     doc UITestFailure
@@ -99,7 +112,7 @@ python_docstrings() {
 
 substitute_ocr_default_mode() {
     local mode=$(sed -n '/^class OcrMode/,/^[^ ]/ p' stbt.py | awk '/3/ {print $1}')
-    sed "/^ocr(/ s/mode=3/mode=OcrMode.$mode/"
+    sed "/^ocr\(_many\)\?(/ s/mode=3/mode=OcrMode.$mode/"
 }
 
 # stbt.as_precondition's `@contextmanager` decorator screws up the function
@@ -120,6 +133,7 @@ substitute_default_params() {
         match.confirm_method \
         match.erode_passes \
         match.confirm_threshold \
+        match.pyramid_levels \
         motion.noise_threshold \
         motion.consecutive_frames \
         press.interpress_delay_secs \
@@ -9,13 +9,18 @@ https://github.com/drothlis/stb-tester/blob/master/LICENSE for details).
 """
 
 import argparse
+import atexit
 import codecs
 import ConfigParser
+import ctypes
+import ctypes.util
 import datetime
 import errno
 import functools
-import glob
+import hashlib
 import inspect
+import math
+import multiprocessing
 import os
 import Queue
 import re
@@ -26,9 +31,10 @@ import tempfile
 import threading
 import time
 import warnings
-from collections import deque, namedtuple
+from collections import OrderedDict, deque, namedtuple
 from contextlib import contextmanager
 from distutils.version import LooseVersion
+from multiprocessing.pool import ThreadPool
 
 import cv2
 import gi
@@ -198,13 +204,21 @@ class MatchParameters(object):
       sensitive to noise and small variances, at the cost of being more likely
       to report a false positive.
 
+    `colour` (bool) default: From stbt.conf
+      If False, the video frame and the template image are converted to
+      grayscale (a single luma channel) before matching. This is about 3 times
+      faster, and works just as well for templates whose colour doesn't help
+      to tell them apart from the rest of the screen, such as text and most
+      icons. Note that with ``colour=False`` a template will match a region
+      of the frame of a different colour but the same brightness.
+
     Please let us know if you are having trouble with image matches so that we
     can further improve the matching algorithm.
     """
 
     def __init__(self, match_method=None, match_threshold=None,
                  confirm_method=None, confirm_threshold=None,
-                 erode_passes=None):
+                 erode_passes=None, colour=None):
         if match_method is None:
             match_method = get_config('match', 'match_method')
         if match_threshold is None:
@@ -217,6 +231,9 @@ class MatchParameters(object):
                 'match', 'confirm_threshold', type_=float)
         if erode_passes is None:
             erode_passes = get_config('match', 'erode_passes', type_=int)
+        if colour is None:
+            colour = (get_config('match', 'colour').lower() in
+                      ("1", "yes", "true", "on"))
 
         if match_method not in (
                 "sqdiff-normed", "ccorr-normed", "ccoeff-normed"):
@@ -229,6 +246,7 @@ class MatchParameters(object):
         self.confirm_method = confirm_method
         self.confirm_threshold = confirm_threshold
         self.erode_passes = erode_passes
+        self.colour = colour
 
 
 class Position(namedtuple('Position', 'x y')):
@@ -300,6 +318,11 @@ class Region(namedtuple('Region', 'x y width height')):
         return (self.x <= other.x and self.y <= other.y and
                 self.right >= other.right and self.bottom >= other.bottom)
 
+    def to_slice(self):
+        """A 2-dimensional slice suitable for indexing a numpy array (such as
+        a video frame in OpenCV format)."""
+        return (slice(self.y, self.bottom), slice(self.x, self.right))
+
 
 def _bounding_box(a, b):
     """Find the bounding box of two regions.  Returns the smallest region which
@@ -323,6 +346,82 @@ def _bounding_box(a, b):
                                max(a.right, b.right), max(a.bottom, b.bottom))
 
 
+class Template(object):
+    """A template image, pre-processed for use by `wait_for_match`,
+    `detect_match` and `press_until_match`.
+
+    You can pass a `Template` anywhere that those functions accept an image
+    filename or an OpenCV image. Loading the image and building the
+    downsampled copies used by the matching algorithm is done once, when the
+    `Template` is created, instead of on every call and every video frame. If
+    you search for the same image many times (for example in a loop), create
+    the `Template` once and re-use it.
+
+    `image` (str or numpy.array)
+      The filename of a png file on disk, or a numpy array containing the
+      template image pixel data in 8-bit BGR format. Relative filenames are
+      searched for in the directory of the script that creates the
+      `Template`.
+
+    `pyramid_levels` (int) default: From stbt.conf
+      The number of downsampled copies of the image to pre-compute. See
+      `pyramid_levels` in the `[match]` section of stbt.conf.
+    """
+
+    def __init__(self, image, pyramid_levels=None):
+        if pyramid_levels is None:
+            pyramid_levels = get_config("match", "pyramid_levels", type_=int)
+        if pyramid_levels <= 0:
+            raise ConfigurationError("'match.pyramid_levels' must be > 0")
+
+        if isinstance(image, numpy.ndarray):
+            self.filename = None
+            self.image = image
+        else:
+            self.filename = _find_path(image)
+            if not os.path.isfile(self.filename):
+                raise UITestError("No such template file: %s" % image)
+            self.image = cv2.imread(self.filename, cv2.CV_LOAD_IMAGE_COLOR)
+            if self.image is None:
+                raise UITestError("Failed to load template file: %s" %
+                                  self.filename)
+
+        if any(self.image.shape[x] < 1 for x in (0, 1)):
+            raise ValueError("Template image must contain some data")
+        if len(self.image.shape) != 3 or self.image.shape[2] != 3:
+            raise ValueError("Template image must be 3 channel BGR")
+        if self.image.dtype != numpy.uint8:
+            raise ValueError("Template image must be 8-bits per channel")
+
+        self.pyramid_levels = pyramid_levels
+        self.pyramid = _build_pyramid(self.image, pyramid_levels)
+        self.gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        self.gray_normalized = cv2.normalize(
+            self.gray, None, 0, 255, cv2.NORM_MINMAX)
+        self._gray_pyramid = None
+
+    @property
+    def gray_pyramid(self):
+        """The pyramid of the grayscale image, for matching with
+        ``MatchParameters(colour=False)``. Built on first use.
+        """
+        if self._gray_pyramid is None:
+            self._gray_pyramid = _build_pyramid(self.gray, self.pyramid_levels)
+        return self._gray_pyramid
+
+    @property
+    def name(self):
+        return self.filename or "<Custom Image>"
+
+    @property
+    def width(self):
+        return self.image.shape[1]
+
+    @property
+    def height(self):
+        return self.image.shape[0]
+
+
 class MatchResult(object):
     """
     * `timestamp`: Video stream timestamp.
@@ -331,9 +430,11 @@ class MatchResult(object):
     * `region`: The `Region` in the video frame where the image was found.
     * `first_pass_result`: Value between 0 (poor) and 1.0 (excellent match)
       from the first pass of the two-pass templatematch algorithm.
-    * `frame`: The video frame that was searched, in OpenCV format.
+    * `frame`: The video frame that was searched, in OpenCV format. (This is
+      only copied out of the video pipeline the first time you access it.)
     * `image`: The template image that was searched for, as given to
-      `wait_for_match` or `detect_match`.
+      `wait_for_match` or `detect_match` (a filename, an OpenCV image, or a
+      `Template`).
     * `position`: `Position` of the match, the same as in `region`. Included
       for backwards compatibility; we recommend using `region` instead.
     """
@@ -351,6 +452,10 @@ class MatchResult(object):
                 "deprecated. In a future release of stb-tester the 'frame' "
                 "parameter will be mandatory.",
                 DeprecationWarning, stacklevel=2)
+        # `frame` can be a `Gst.Sample`, which is converted to an OpenCV
+        # image only if `self.frame` is used.
+        self._sample = None
+        self._frame = None
         self.frame = frame
         if image is None:
             warnings.warn(
@@ -369,11 +474,35 @@ class MatchResult(object):
                 self.match,
                 self.region,
                 self.first_pass_result,
-                "None" if self.frame is None else "%dx%dx%d" % (
-                    self.frame.shape[1], self.frame.shape[0],
-                    self.frame.shape[2]),
+                "None" if self._frame_shape is None else "%dx%dx%d" % (
+                    self._frame_shape[1], self._frame_shape[0],
+                    self._frame_shape[2]),
                 _template_name(self.image)))
 
+    @property
+    def frame(self):
+        if self._frame is None and self._sample is not None:
+            with _numpy_from_sample(self._sample, readonly=True) as frame:
+                self._frame = frame.copy()
+            self._sample = None
+        return self._frame
+
+    @frame.setter
+    def frame(self, frame):
+        if isinstance(frame, Gst.Sample):
+            self._sample, self._frame = frame, None
+        else:
+            self._sample, self._frame = None, frame
+
+    @property
+    def _frame_shape(self):
+        if self._sample is not None:
+            return _sample_shape(self._sample)
+        elif self._frame is not None:
+            return self._frame.shape
+        else:
+            return None
+
     @property
     def position(self):
         return Position(self.region.x, self.region.y)
@@ -383,7 +512,8 @@ class MatchResult(object):
 
 
 def detect_match(image, timeout_secs=10, noise_threshold=None,
-                 match_parameters=None):
+                 match_parameters=None, region=None, tracking=False,
+                 analysis_fps=None, every_nth_frame=None):
     """Generator that yields a sequence of one `MatchResult` for each frame
     processed from the source video stream.
 
@@ -393,6 +523,8 @@ def detect_match(image, timeout_secs=10, noise_threshold=None,
     arrays are the same format that OpenCV uses for images.  This allows
     generating templates on the fly (possibly using OpenCV) or searching for
     images captured from the system under test earlier in the test script.
+    It can also be a `Template`, which avoids re-processing the image on every
+    call.
 
     Returns after `timeout_secs` seconds. (Note that the caller can also choose
     to stop iterating over this function's results at any time.)
@@ -404,6 +536,24 @@ def detect_match(image, timeout_secs=10, noise_threshold=None,
 
     Specify `match_parameters` to customise the image matching algorithm. See
     the documentation for `MatchParameters` for details.
+
+    `region` (Region) default: None
+      Only search for `image` within this region of the video frame, instead
+      of the entire frame. This is faster, and avoids false matches elsewhere
+      in the frame. The `MatchResult` still reports positions relative to the
+      top left of the entire video frame.
+
+    `tracking` (bool) default: False
+      Once `image` has been found, search for it in the next frame near the
+      position where it was last found first, and only search the rest of the
+      frame if it isn't there any more. This makes following a match from
+      frame to frame (for example a moving highlight or cursor) much faster.
+      The size of the neighbourhood is configured with `tracking_margin` (in
+      pixels) in the `[match]` section of stbt.conf.
+
+    `analysis_fps` (float), `every_nth_frame` (int) default: From stbt.conf
+      Only analyse some of the video frames, to limit the CPU usage. See
+      `frames`.
     """
 
     if match_parameters is None:
@@ -417,41 +567,129 @@ def detect_match(image, timeout_secs=10, noise_threshold=None,
             DeprecationWarning, stacklevel=2)
         match_parameters.confirm_threshold = noise_threshold
 
-    if isinstance(image, numpy.ndarray):
-        template = image
-        template_name = _template_name(image)
-    else:
-        template_name = _find_path(image)
-        if not os.path.isfile(template_name):
-            raise UITestError("No such template file: %s" % image)
-        template = cv2.imread(template_name, cv2.CV_LOAD_IMAGE_COLOR)
-        if template is None:
-            raise UITestError("Failed to load template file: %s" %
-                              template_name)
+    for results in detect_matches(
+            [image], timeout_secs, match_parameters, region, tracking,
+            analysis_fps, every_nth_frame):
+        yield results[0]
 
-    debug("Searching for " + template_name)
 
-    for sample in _display.gst_samples(timeout_secs):
-        with _numpy_from_sample(sample) as frame:
-            matched, region, first_pass_certainty = _match(
-                frame, template, match_parameters, template_name)
+def detect_matches(images, timeout_secs=10, match_parameters=None,
+                   region=None, tracking=False, analysis_fps=None,
+                   every_nth_frame=None):
+    """Generator that yields, for each frame processed from the source video
+    stream, a list of `MatchResult`s: One for each image in `images`, in the
+    same order as `images`.
 
-            result = MatchResult(
-                sample.get_buffer().pts, matched, region, first_pass_certainty,
-                numpy.copy(frame),
-                (image if isinstance(image, numpy.ndarray) else template_name))
+    This is faster than calling `detect_match` once for each image: Each video
+    frame is captured and pre-processed once, and then all the images are
+    searched for in that same frame. If `threads` in the `[match]` section of
+    stbt.conf is greater than 1, the images are searched for in parallel.
 
-            cv2.rectangle(
-                frame,
-                (region.x, region.y), (region.right, region.bottom),
-                (32, 0 if matched else 255, 255),  # bgr
-                thickness=3)
+    `images` is a list of the images to search for. Each image can be the
+    filename of a png file on disk, a numpy array containing the template
+    image pixel data in 8-bit BGR format, or a `Template` (see
+    `detect_match`).
 
-        if matched:
-            debug("Match found: %s" % str(result))
-        else:
-            debug("No match found. Closest match: %s" % str(result))
-        yield result
+    Returns after `timeout_secs` seconds. (Note that the caller can also choose
+    to stop iterating over this function's results at any time.)
+
+    `match_parameters` (MatchParameters or list) default: MatchParameters()
+      Customise the image matching algorithm. See the documentation for
+      `MatchParameters` for details. Either a single `MatchParameters` to use
+      for all of the images, or a list of `MatchParameters` with one entry for
+      each image in `images`.
+
+    `region` (Region) default: None
+      Only search within this region of the video frame. See `detect_match`.
+
+    `tracking` (bool) default: False
+      Search near the position of each image's previous match first. See
+      `detect_match`.
+
+    `analysis_fps` (float), `every_nth_frame` (int) default: From stbt.conf
+      Only analyse some of the video frames. See `frames`.
+    """
+
+    if not images:
+        raise ValueError("detect_matches: No images to search for")
+    templates = [_load_template(image) for image in images]
+    if match_parameters is None:
+        match_parameters = MatchParameters()
+    if isinstance(match_parameters, MatchParameters):
+        match_parameters = [match_parameters] * len(templates)
+    if len(match_parameters) != len(templates):
+        raise ValueError(
+            "Got %d match_parameters for %d images" % (
+                len(match_parameters), len(templates)))
+
+    for template in templates:
+        debug("Searching for " + template.name)
+
+    pyramid_levels = max(len(t.pyramid) for t in templates)
+    results = [None] * len(templates)
+    signature = None
+
+    for sample in _display.gst_samples(
+            timeout_secs, analysis_fps=analysis_fps,
+            every_nth_frame=every_nth_frame):
+        previous_results, results = results, []
+        unchanged, signature = _display.frame_dedup.check(sample, signature)
+        with _numpy_from_sample(sample, readonly=True) as frame:
+            search_region = _clip_region(region, frame)
+
+            # Note: `MatchResult` is truthy only if it matched, but we can
+            # re-use results that didn't match too.
+            if unchanged and all(r is not None for r in previous_results):
+                _display.frame_dedup.reused()
+                results = [
+                    MatchResult(
+                        sample.get_buffer().pts, previous.match,
+                        previous.region, previous.first_pass_result,
+                        sample, previous.image)
+                    for previous in previous_results]
+            else:
+                # The frame is converted to grayscale (for templates with
+                # `MatchParameters(colour=False)`) once, and its image
+                # pyramids are shared by all templates. The pyramids aren't
+                # needed at all if tracking finds every template.
+                frames = {True: frame}
+                if not all(mp.colour for mp in match_parameters):
+                    frames[False] = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                image_pyramids = {}
+                if not (tracking and all(previous_results)):
+                    for colour, f in frames.items():
+                        image_pyramids[colour] = _build_pyramid(
+                            f[search_region.to_slice()], pyramid_levels)
+
+                # The templates are searched for in parallel (if configured
+                # with `match.threads`).
+                matches = _parallel_map(
+                    "match",
+                    functools.partial(
+                        _match_or_track, frames, search_region, image_pyramids,
+                        tracking),
+                    zip(templates, match_parameters, previous_results))
+                for image, template, (
+                        matched, match_region, first_pass_certainty) in zip(
+                            images, templates, matches):
+                    results.append(MatchResult(
+                        sample.get_buffer().pts, matched, match_region,
+                        first_pass_certainty, sample,
+                        (template.name if isinstance(image, basestring)
+                         else image)))
+
+        # Visualisation: Drawn on the output video, not on `sample` (which the
+        # results refer to).
+        for result in results:
+            _display.draw_region(
+                result.region, (32, 0 if result.match else 255, 255))  # bgr
+
+        for result in results:
+            if result.match:
+                debug("Match found: %s" % str(result))
+            else:
+                debug("No match found. Closest match: %s" % str(result))
+        yield results
 
 
 class MotionResult(namedtuple('MotionResult', 'timestamp motion')):
@@ -462,7 +700,8 @@ class MotionResult(namedtuple('MotionResult', 'timestamp motion')):
     pass
 
 
-def detect_motion(timeout_secs=10, noise_threshold=None, mask=None):
+def detect_motion(timeout_secs=10, noise_threshold=None, mask=None,
+                  analysis_fps=None, every_nth_frame=None):
     """Generator that yields a sequence of one `MotionResult` for each frame
     processed from the source video stream.
 
@@ -481,6 +720,11 @@ def detect_motion(timeout_secs=10, noise_threshold=None, mask=None):
       A mask is a black and white image that specifies which part of the image
       to search for motion. White pixels select the area to search; black
       pixels the area to ignore.
+
+    `analysis_fps` (float), `every_nth_frame` (int) default: From stbt.conf
+      Only analyse some of the video frames, to limit the CPU usage. Motion
+      is detected by comparing each analysed frame with the previous analysed
+      frame. See `frames`.
     """
 
     if noise_threshold is None:
@@ -488,62 +732,118 @@ def detect_motion(timeout_secs=10, noise_threshold=None, mask=None):
 
     debug("Searching for motion")
 
-    mask_image = None
-    if mask:
-        mask_image = _load_mask(mask)
-
-    previous_frame_gray = None
-    log = functools.partial(_log_image, directory="stbt-debug/detect_motion")
+    detector = _MotionDetector(noise_threshold, mask)
+    signature = None
+
+    for sample in _display.gst_samples(
+            timeout_secs, analysis_fps=analysis_fps,
+            every_nth_frame=every_nth_frame):
+        unchanged, signature = _display.frame_dedup.check(sample, signature)
+        if unchanged and detector.started:
+            # No need to compare against this frame: Compare the next frame
+            # against the last frame we actually analysed instead.
+            _display.frame_dedup.reused()
+            result = MotionResult(sample.get_buffer().pts, False)
+            debug("No motion found: %s" % str(result))
+            yield result
+            continue
 
-    for sample in _display.gst_samples(timeout_secs):
         with _numpy_from_sample(sample, readonly=True) as frame:
-            frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        log(frame_gray, "source")
-
-        if previous_frame_gray is None:
-            if (mask_image is not None and
-                    mask_image.shape[:2] != frame_gray.shape[:2]):
-                raise UITestError(
-                    "The dimensions of the mask '%s' %s don't match the video "
-                    "frame %s" % (mask, mask_image.shape, frame_gray.shape))
-            previous_frame_gray = frame_gray
-            continue
+            motion_mask = detector.detect(frame)
+        if motion_mask is None:
+            continue  # First frame: Nothing to compare against yet.
 
-        absdiff = cv2.absdiff(frame_gray, previous_frame_gray)
-        previous_frame_gray = frame_gray
-        log(absdiff, "absdiff")
+        motion = (cv2.countNonZero(motion_mask) > 0)
 
-        if mask_image is not None:
-            absdiff = cv2.bitwise_and(absdiff, mask_image)
-            log(mask_image, "mask")
-            log(absdiff, "absdiff_masked")
+        # Visualisation: Highlight in red the areas where we detected motion
+        if motion:
+            _display.draw_overlay(detector.highlight)
 
-        _, thresholded = cv2.threshold(
-            absdiff, int((1 - noise_threshold) * 255), 255, cv2.THRESH_BINARY)
-        eroded = cv2.erode(
-            thresholded,
-            cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
-        log(thresholded, "absdiff_threshold")
-        log(eroded, "absdiff_threshold_erode")
+        result = MotionResult(sample.get_buffer().pts, motion)
+        debug("%s found: %s" % (
+            "Motion" if motion else "No motion", str(result)))
+        yield result
 
-        motion = (cv2.countNonZero(eroded) > 0)
 
-        # Visualisation: Highlight in red the areas where we detected motion
+class RegionMotion(namedtuple(
+        'RegionMotion', 'region motion changed_pixels bounding_box')):
+    """
+    * `region`: The `Region` that was searched for motion.
+    * `motion`: Boolean result.
+    * `changed_pixels`: The number of pixels in `region` that changed (this is
+      approximate if `motion.scale` in stbt.conf is less than 1).
+    * `bounding_box`: The `Region` enclosing the pixels that changed, or None
+      if there was no motion.
+    """
+    pass
+
+
+class MotionRegionsResult(namedtuple(
+        'MotionRegionsResult', 'timestamp motion regions')):
+    """
+    * `timestamp`: Video stream timestamp.
+    * `motion`: True if there was motion in any of the regions.
+    * `regions`: A list of `RegionMotion`, one for each region given to
+      `detect_motion_regions`, in the same order.
+    """
+    pass
+
+
+def detect_motion_regions(regions, timeout_secs=10, noise_threshold=None):
+    """Generator that yields a sequence of one `MotionRegionsResult` for each
+    frame processed from the source video stream, reporting whether there was
+    motion in each of several regions of the frame.
+
+    This is faster than calling `detect_motion` (with a mask) once for each
+    region: Each frame is compared against the previous frame once, and the
+    result is used for all of the regions. It also means that the motion in
+    all of the regions is measured in the same frames.
+
+    `regions` is a list of `Region`s of the video frame.
+
+    Returns after `timeout_secs` seconds. (Note that the caller can also choose
+    to stop iterating over this function's results at any time.)
+
+    `noise_threshold` (float) default: From stbt.conf
+      See `detect_motion`.
+    """
+
+    if not regions:
+        raise ValueError("regions must not be empty")
+    if noise_threshold is None:
+        noise_threshold = get_config('motion', 'noise_threshold', type_=float)
+
+    debug("Searching for motion in regions %s" % ", ".join(
+        str(r) for r in regions))
+
+    detector = _MotionDetector(noise_threshold, regions=regions)
+    signature = None
+
+    for sample in _display.gst_samples(timeout_secs):
+        unchanged, signature = _display.frame_dedup.check(sample, signature)
+        if unchanged and detector.started:
+            _display.frame_dedup.reused()
+            result = MotionRegionsResult(
+                sample.get_buffer().pts, False,
+                [RegionMotion(r, False, 0, None) for r in detector.regions])
+            debug("No motion found: %s" % str(result))
+            yield result
+            continue
+
+        with _numpy_from_sample(sample, readonly=True) as frame:
+            motion_mask = detector.detect(frame)
+        if motion_mask is None:
+            continue  # First frame: Nothing to compare against yet.
+
+        region_motions = [
+            detector.region_motion(motion_mask, r) for r in detector.regions]
+        motion = any(r.motion for r in region_motions)
+
         if motion:
-            with _numpy_from_sample(sample) as frame:
-                cv2.add(
-                    frame,
-                    numpy.multiply(
-                        numpy.ones(frame.shape, dtype=numpy.uint8),
-                        (0, 0, 255),  # bgr
-                        dtype=numpy.uint8),
-                    mask=cv2.dilate(
-                        thresholded,
-                        cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)),
-                        iterations=1),
-                    dst=frame)
+            _display.draw_overlay(detector.highlight)
 
-        result = MotionResult(sample.get_buffer().pts, motion)
+        result = MotionRegionsResult(
+            sample.get_buffer().pts, motion, region_motions)
         debug("%s found: %s" % (
             "Motion" if motion else "No motion", str(result)))
         yield result
@@ -552,6 +852,8 @@ def detect_motion(timeout_secs=10, noise_threshold=None, mask=None):
 def _template_name(template):
     if isinstance(template, numpy.ndarray):
         return "<Custom Image>"
+    elif isinstance(template, Template):
+        return template.name
     elif isinstance(template, str) or isinstance(template, unicode):
         return template
     else:
@@ -560,7 +862,8 @@ def _template_name(template):
 
 
 def wait_for_match(image, timeout_secs=10, consecutive_matches=1,
-                   noise_threshold=None, match_parameters=None):
+                   noise_threshold=None, match_parameters=None, region=None,
+                   tracking=False):
     """Search for `image` in the source video stream.
 
     Returns `MatchResult` when `image` is found.
@@ -572,6 +875,8 @@ def wait_for_match(image, timeout_secs=10, consecutive_matches=1,
     arrays are the same format that OpenCV uses for images.  This allows
     generating templates on the fly (possibly using OpenCV) or searching for
     images captured from the system under test earlier in the test script.
+    It can also be a `Template`, which avoids re-processing the image on every
+    call.
 
     `consecutive_matches` forces this function to wait for several consecutive
     frames with a match found at the same x,y position. Increase
@@ -584,6 +889,15 @@ def wait_for_match(image, timeout_secs=10, consecutive_matches=1,
 
     Specify `match_parameters` to customise the image matching algorithm. See
     the documentation for `MatchParameters` for details.
+
+    `region` (Region) default: None
+      Only search for `image` within this region of the video frame. See
+      `detect_match`.
+
+    `tracking` (bool) default: False
+      Once `image` has been found, search for it near the same position first
+      in the following frames. This makes `consecutive_matches` greater than 1
+      much cheaper. See `detect_match`.
     """
 
     if match_parameters is None:
@@ -600,7 +914,8 @@ def wait_for_match(image, timeout_secs=10, consecutive_matches=1,
     match_count = 0
     last_pos = Position(0, 0)
     for res in detect_match(
-            image, timeout_secs, match_parameters=match_parameters):
+            image, timeout_secs, match_parameters=match_parameters,
+            region=region, tracking=tracking):
         if res.match and (match_count == 0 or res.position == last_pos):
             match_count += 1
         else:
@@ -613,13 +928,67 @@ def wait_for_match(image, timeout_secs=10, consecutive_matches=1,
     raise MatchTimeout(res.frame, _template_name(image), timeout_secs)  # pylint: disable=W0631,C0301
 
 
+def wait_for_any_match(images, timeout_secs=10, consecutive_matches=1,
+                       match_parameters=None, region=None, tracking=False):
+    """Search for any of `images` in the source video stream.
+
+    Returns the `MatchResult` of the first image found. If more than one of
+    the images is found in the same frame, the earliest one in `images` is
+    returned. Use `MatchResult.image` to tell which image was found.
+
+    Raises `MatchTimeout` if none of the images is found after `timeout_secs`
+    seconds.
+
+    Each video frame is searched for all of the images at once (see
+    `detect_matches`), so this is much faster than calling `wait_for_match`
+    for each image in turn.
+
+    `images` is a list of images; see `detect_matches`.
+
+    `consecutive_matches` forces this function to wait for several consecutive
+    frames with a match for the same image found at the same x,y position.
+
+    `match_parameters` (MatchParameters or list) default: MatchParameters()
+      Customise the image matching algorithm. See `detect_matches`.
+
+    `region` (Region) default: None
+      Only search within this region of the video frame. See `detect_match`.
+
+    `tracking` (bool) default: False
+      Search near the position of each image's previous match first. See
+      `detect_match`.
+    """
+
+    match_counts = [0] * len(images)
+    last_positions = [Position(0, 0)] * len(images)
+    for results in detect_matches(
+            images, timeout_secs, match_parameters, region, tracking):
+        for i, res in enumerate(results):
+            if res.match and (
+                    match_counts[i] == 0 or res.position == last_positions[i]):
+                match_counts[i] += 1
+            else:
+                match_counts[i] = 0
+            last_positions[i] = res.position
+        for i, res in enumerate(results):
+            if match_counts[i] == consecutive_matches:
+                debug("Matched " + _template_name(res.image))
+                return res
+
+    # pylint: disable=W0631
+    raise MatchTimeout(
+        results[0].frame,
+        ", ".join(_template_name(x.image) for x in results), timeout_secs)
+
+
 def press_until_match(
         key,
         image,
         interval_secs=None,
         noise_threshold=None,
         max_presses=None,
-        match_parameters=None):
+        match_parameters=None,
+        region=None):
     """Calls `press` as many times as necessary to find the specified `image`.
 
     Returns `MatchResult` when `image` is found.
@@ -641,6 +1010,10 @@ def press_until_match(
     `match_parameters` (MatchParameters) default: MatchParameters()
       Customise the image matching algorithm. See the documentation for
       `MatchParameters` for details.
+
+    `region` (Region) default: None
+      Only search for `image` within this region of the video frame. See
+      `detect_match`.
     """
     if interval_secs is None:
         # Should this be float?
@@ -665,7 +1038,8 @@ def press_until_match(
     while True:
         try:
             return wait_for_match(image, timeout_secs=interval_secs,
-                                  match_parameters=match_parameters)
+                                  match_parameters=match_parameters,
+                                  region=region)
         except MatchTimeout:
             if i < max_presses:
                 press(key)
@@ -736,6 +1110,59 @@ def wait_for_motion(
     raise MotionTimeout(screenshot, mask, timeout_secs)
 
 
+class StableResult(namedtuple('StableResult', 'timestamp settle_secs')):
+    """
+    * `timestamp`: Video stream timestamp of the frame at which the screen was
+      considered stable (`stable_secs` after the last motion).
+    * `settle_secs`: How long the screen took to settle: The time from the
+      first frame that `wait_for_stable` looked at, to the last frame with
+      motion (0 if there was no motion at all).
+    """
+    pass
+
+
+def wait_for_stable(
+        timeout_secs=10, stable_secs=1, mask=None, noise_threshold=None):
+    """Wait for the source video stream to stop changing (for example after
+    pressing a button that starts an animation, instead of using a fixed
+    `time.sleep`).
+
+    Returns `StableResult` as soon as no motion has been detected for
+    `stable_secs` seconds.
+    Raises `StableTimeout` if the screen doesn't become stable within
+    `timeout_secs` seconds.
+
+    `stable_secs` (float) default: 1
+      How long the screen must stay still to be considered stable.
+
+    `mask` (str) default: None
+      A black and white image that specifies which part of the image to search
+      for motion. See `wait_for_motion`. Use this to ignore parts of the screen
+      that are always moving, such as a clock or a video window.
+
+    `noise_threshold` (float) default: From stbt.conf
+      See `wait_for_motion`.
+    """
+
+    debug("Waiting for %g seconds without motion" % stable_secs)
+
+    start = None
+    last_motion = None
+    for res in detect_motion(timeout_secs, noise_threshold, mask):
+        if start is None:
+            start = res.timestamp
+        if res.motion:
+            last_motion = res.timestamp
+        still_since = start if last_motion is None else last_motion
+        if res.timestamp - still_since >= stable_secs * 1e9:
+            result = StableResult(res.timestamp, (still_since - start) / 1e9)
+            debug("Screen stable: %s" % str(result))
+            return result
+
+    screenshot = get_frame()
+    raise StableTimeout(screenshot, mask, timeout_secs, stable_secs)
+
+
 class OcrMode(object):
     """Options to control layout analysis and assume a certain form of image.
 
@@ -795,14 +1222,22 @@ def _named_temporary_directory(
         rmtree(dirname)
 
 
+_memoise_tessdata_dir = None
+
+
 def _find_tessdata_dir():
+    global _memoise_tessdata_dir
+    if _memoise_tessdata_dir is not None:
+        return _memoise_tessdata_dir
+
     from distutils.spawn import find_executable
     tess_prefix_share = os.path.normpath(
         find_executable('tesseract') + '/../../share/')
     for suffix in [
             '/tessdata', '/tesseract-ocr/tessdata', '/tesseract/tessdata']:
         if os.path.exists(tess_prefix_share + suffix):
-            return tess_prefix_share + suffix
+            _memoise_tessdata_dir = tess_prefix_share + suffix
+            return _memoise_tessdata_dir
     raise RuntimeError('Installation error: Cannot locate tessdata directory')
 
 
@@ -846,11 +1281,22 @@ def _tesseract_version(output=None):
 
 
 def _tesseract(frame, region=None, mode=OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD,
-               lang=None, config=None, user_patterns=None, user_words=None):
+               lang=None, config=None, user_patterns=None, user_words=None,
+               engine=None):
     if lang is None:
         lang = 'eng'
-    if config is None:
-        config = {}
+    config = dict(config or {})
+    if engine is None:
+        engine = get_config('ocr', 'engine')
+    if engine not in ("auto", "library", "subprocess"):
+        raise ConfigurationError(
+            "Invalid value '%s' for 'ocr.engine' (must be 'auto', 'library' "
+            "or 'subprocess')" % engine)
+
+    if user_patterns and _tesseract_version() < LooseVersion('3.03'):
+        raise RuntimeError(
+            'tesseract version >=3.03 is required for user_patterns.  '
+            'version %s is currently installed' % _tesseract_version())
 
     with _numpy_from_sample(frame, readonly=True) as f:
         if region is None:
@@ -858,6 +1304,12 @@ def _tesseract(frame, region=None, mode=OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD,
 
         subframe = f[region.y:region.bottom, region.x:region.right]
 
+        cache_key = _ocr_cache.key(
+            subframe, mode, lang, config, user_patterns, user_words)
+        text = _ocr_cache.get(cache_key)
+        if text is not None:
+            return (text, region)
+
         # We scale image up 3x before feeding it to tesseract as this
         # significantly reduces the error rate by more than 6x in tests.  This
         # uses bilinear interpolation which produces the best results.  See
@@ -865,6 +1317,118 @@ def _tesseract(frame, region=None, mode=OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD,
         outsize = (region.width * 3, region.height * 3)
         subframe = cv2.resize(subframe, outsize, interpolation=cv2.INTER_LINEAR)
 
+    text = None
+    use_library = (engine == "library" or
+                   engine == "auto" and not _libtesseract_failed)
+    # The tesseract program writes hOCR output instead of text if asked to;
+    # the library always gives us text.
+    if use_library and not config.get('tessedit_create_hocr'):
+        try:
+            tess = _get_tesseract_engine(lang, config, user_patterns,
+                                         user_words)
+        except (OSError, RuntimeError) as e:
+            if engine == "library":
+                raise
+            ddebug("Using the tesseract program instead of libtesseract: %s"
+                   % e)
+        else:
+            try:
+                text = tess.recognise(subframe, mode)
+            except (RuntimeError, ctypes.ArgumentError) as e:
+                if engine == "library":
+                    raise
+                _on_libtesseract_failure(e)
+    if text is None:
+        text = _tesseract_subprocess(
+            subframe, mode, lang, config, user_patterns, user_words)
+
+    _ocr_cache.put(cache_key, text)
+    return (text, region)
+
+
+class _OcrCache(object):
+    """The results of `_tesseract`, keyed by a hash of the pixels of the
+    region being read and all the parameters that can affect the result, so
+    that we never run tesseract on the same pixels twice. Holds at most
+    `maxsize` results (default: `ocr.cache_size` from stbt.conf).
+
+    Used from several threads at once by `ocr_many`.
+    """
+
+    def __init__(self, maxsize=None):
+        self.hits = 0
+        self.misses = 0
+        self._cache = None if maxsize is None else _LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def key(self, image, mode, lang, config, user_patterns, user_words):
+        """Returns None if the cache is disabled."""
+        with self._lock:
+            if self._cache is None:
+                self._cache = _LRUCache(
+                    maxsize=get_config('ocr', 'cache_size', type_=int))
+        if self._cache.maxsize <= 0:
+            return None
+        return (hashlib.sha1(numpy.ascontiguousarray(image)).digest(),
+                image.shape, mode,
+                _tesseract_key(lang, config, user_patterns, user_words))
+
+    def get(self, key):
+        if key is None:
+            return None
+        text = self._cache.get(key)
+        with self._lock:
+            if text is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            stats = self.stats()
+        ddebug("OCR cache hit (%s)" % stats)
+        return text
+
+    def put(self, key, text):
+        if key is not None:
+            self._cache[key] = text
+
+    def stats(self):
+        return "%d hits, %d misses" % (self.hits, self.misses)
+
+
+_ocr_cache = _OcrCache()
+
+
+def _tesseract_subprocess(image, mode, lang, config, user_patterns,
+                          user_words):
+    tessenv = os.environ.copy()
+    configs = []
+    if config or user_words or user_patterns:
+        prefix, configs = _prepared_tessdata(
+            lang, config, user_patterns, user_words)
+        tessenv['TESSDATA_PREFIX'] = prefix
+
+    if _tesseract_version() < LooseVersion('3.03'):
+        return _tesseract_subprocess_with_files(
+            image, mode, lang, configs, tessenv)
+
+    # Tesseract >= 3.03 can read the image from stdin and write the text to
+    # stdout. We send it an uncompressed PPM image: Compressing it (as PNG) is
+    # a significant part of the time taken to read a small region.
+    cmd = ["tesseract", '-l', lang, 'stdin', 'stdout', "-psm", str(mode)]
+    cmd += configs
+    ok, ppm = cv2.imencode('.ppm', image)
+    if not ok:
+        raise RuntimeError("Failed to encode the image for tesseract")
+    tesseract = subprocess.Popen(
+        cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, env=tessenv)
+    text, errors = tesseract.communicate(ppm.tostring())
+    if tesseract.returncode != 0:
+        raise subprocess.CalledProcessError(
+            tesseract.returncode, cmd, output=errors)
+    return text
+
+
+def _tesseract_subprocess_with_files(image, mode, lang, configs, tessenv):
     # $XDG_RUNTIME_DIR is likely to be on tmpfs:
     tmpdir = os.environ.get("XDG_RUNTIME_DIR", None)
 
@@ -880,45 +1444,226 @@ def _tesseract(frame, region=None, mode=OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD,
 
         cmd = ["tesseract", '-l', lang, tmp + '/input.png',
                outdir + '/output', "-psm", str(mode)]
+        cmd += configs
 
-        tessenv = os.environ.copy()
-
-        if config or user_words or user_patterns:
-            tessdata_dir = tmp + '/tessdata'
-            os.mkdir(tessdata_dir)
-            _symlink_copy_dir(_find_tessdata_dir(), tmp)
-            tessenv['TESSDATA_PREFIX'] = tmp + '/'
-
-        if user_words:
-            assert 'user_words_suffix' not in config
-            with open('%s/%s.user-words' % (tessdata_dir, lang), 'w') as f:
-                f.write('\n'.join(user_words).encode('utf-8'))
-            config['user_words_suffix'] = 'user-words'
-
-        if user_patterns:
-            assert 'user_patterns_suffix' not in config
-            if _tesseract_version() < LooseVersion('3.03'):
-                raise RuntimeError(
-                    'tesseract version >=3.03 is required for user_patterns.  '
-                    'version %s is currently installed' % _tesseract_version())
-            with open('%s/%s.user-patterns' % (tessdata_dir, lang), 'w') as f:
-                f.write('\n'.join(user_patterns).encode('utf-8'))
-            config['user_patterns_suffix'] = 'user-patterns'
-
-        if config:
-            with open(tessdata_dir + '/configs/stbtester', 'w') as cfg:
-                for k, v in config.iteritems():
-                    if isinstance(v, bool):
-                        cfg.write(('%s %s\n' % (k, 'T' if v else 'F')))
-                    else:
-                        cfg.write((u"%s %s\n" % (k, unicode(v)))
-                                  .encode('utf-8'))
-            cmd += ['stbtester']
-
-        cv2.imwrite(tmp + '/input.png', subframe)
+        cv2.imwrite(tmp + '/input.png', image)
         subprocess.check_output(cmd, stderr=subprocess.STDOUT, env=tessenv)
         with open(outdir + '/' + os.listdir(outdir)[0], 'r') as outfile:
-            return (outfile.read(), region)
+            return outfile.read()
+
+
+def _tesseract_key(lang, config, user_patterns, user_words):
+    """The parameters that affect how tesseract is set up, as a hashable
+    key.
+    """
+    return (lang, tuple(sorted(config.items())), tuple(user_patterns or ()),
+            tuple(user_words or ()))
+
+
+# Copies of the tessdata directory prepared by `_tesseract_configs`, as
+# `(TESSDATA_PREFIX, config names)` keyed by `_tesseract_key`. They are kept
+# until the end of the test run: See `_remove_prepared_tessdata`.
+_prepared_tessdata_dirs = {}
+_prepared_tessdata_lock = threading.Lock()
+
+
+def _prepared_tessdata(lang, config, user_patterns, user_words):
+    """Returns `(prefix, configs)`: A `TESSDATA_PREFIX` with our `config`,
+    `user_patterns` and `user_words` added to the tessdata directory, and the
+    names of the tesseract config files to use. Setting up the directory is
+    slow, so we only do it once for each combination of parameters.
+    """
+    key = _tesseract_key(lang, config, user_patterns, user_words)
+    with _prepared_tessdata_lock:
+        if key not in _prepared_tessdata_dirs:
+            if not _prepared_tessdata_dirs:
+                atexit.register(_remove_prepared_tessdata)
+            # $XDG_RUNTIME_DIR is likely to be on tmpfs:
+            tmp = tempfile.mkdtemp(
+                prefix='stbt-ocr-tessdata-',
+                dir=os.environ.get("XDG_RUNTIME_DIR", None))
+            _prepared_tessdata_dirs[key] = (tmp + '/', _tesseract_configs(
+                tmp, lang, config, user_patterns, user_words))
+        return _prepared_tessdata_dirs[key]
+
+
+def _remove_prepared_tessdata():
+    from shutil import rmtree
+    with _prepared_tessdata_lock:
+        for prefix, _ in _prepared_tessdata_dirs.values():
+            rmtree(prefix, ignore_errors=True)
+        _prepared_tessdata_dirs.clear()
+
+
+def _tesseract_configs(tmp, lang, config, user_patterns, user_words):
+    """Creates a copy of the tessdata directory in `tmp` with our `config`,
+    `user_patterns` and `user_words` added. Returns the names of the
+    tesseract config files to use; the copy of tessdata must be used as
+    `TESSDATA_PREFIX`.
+    """
+    config = dict(config)
+    tessdata_dir = tmp + '/tessdata'
+    os.mkdir(tessdata_dir)
+    _symlink_copy_dir(_find_tessdata_dir(), tmp)
+
+    if user_words:
+        assert 'user_words_suffix' not in config
+        with open('%s/%s.user-words' % (tessdata_dir, lang), 'w') as f:
+            f.write('\n'.join(user_words).encode('utf-8'))
+        config['user_words_suffix'] = 'user-words'
+
+    if user_patterns:
+        assert 'user_patterns_suffix' not in config
+        with open('%s/%s.user-patterns' % (tessdata_dir, lang), 'w') as f:
+            f.write('\n'.join(user_patterns).encode('utf-8'))
+        config['user_patterns_suffix'] = 'user-patterns'
+
+    if not config:
+        return []
+    with open(tessdata_dir + '/configs/stbtester', 'w') as cfg:
+        for k, v in config.iteritems():
+            if isinstance(v, bool):
+                cfg.write(('%s %s\n' % (k, 'T' if v else 'F')))
+            else:
+                cfg.write((u"%s %s\n" % (k, unicode(v))).encode('utf-8'))
+    return ['stbtester']
+
+
+_libtesseract = None
+_libtesseract_failed = False
+_libtesseract_failed_lock = threading.Lock()
+
+
+def _on_libtesseract_failure(e):
+    """Called when libtesseract loaded but failed to read an image (e.g.
+    because the installed libtesseract isn't compatible with the API we
+    declare in `_declare_libtesseract`): With `ocr.engine = auto`, use the
+    tesseract program for the rest of the test run.
+    """
+    global _libtesseract_failed
+    with _libtesseract_failed_lock:
+        if not _libtesseract_failed:
+            _libtesseract_failed = True
+            warn("libtesseract failed to read the image (%s); using the "
+                 "tesseract program instead" % e)
+
+
+def _load_libtesseract():
+    """Loads libtesseract (the Tesseract C API) with ctypes. Raises OSError if
+    it isn't installed.
+    """
+    global _libtesseract
+    if _libtesseract is None:
+        name = ctypes.util.find_library('tesseract')
+        if name is None:
+            _libtesseract = OSError("libtesseract not found")
+        else:
+            try:
+                _libtesseract = _declare_libtesseract(ctypes.CDLL(name))
+            except (OSError, AttributeError) as e:
+                _libtesseract = OSError("Failed to load %s: %s" % (name, e))
+        if isinstance(_libtesseract, Exception):
+            debug("Can't use libtesseract: %s" % _libtesseract)
+    if isinstance(_libtesseract, Exception):
+        raise _libtesseract  # pylint: disable=E0702
+    return _libtesseract
+
+
+def _declare_libtesseract(lib):
+    c_char_p, c_int, c_void_p = ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p
+    for name, restype, argtypes in [
+            ("TessBaseAPICreate", c_void_p, []),
+            ("TessBaseAPIDelete", None, [c_void_p]),
+            ("TessBaseAPIEnd", None, [c_void_p]),
+            ("TessBaseAPIInit1", c_int,
+             [c_void_p, c_char_p, c_char_p, c_int, ctypes.POINTER(c_char_p),
+              c_int]),
+            ("TessBaseAPISetPageSegMode", None, [c_void_p, c_int]),
+            ("TessBaseAPISetImage", None,
+             [c_void_p, c_void_p, c_int, c_int, c_int, c_int]),
+            ("TessBaseAPIGetUTF8Text", c_void_p, [c_void_p]),
+            ("TessDeleteText", None, [c_void_p])]:
+        function = getattr(lib, name)
+        function.restype = restype
+        function.argtypes = argtypes
+    return lib
+
+
+class _TesseractEngine(object):
+    """A Tesseract engine, from libtesseract, that has loaded the language
+    data for `lang` (and the config files `configs` from the tessdata
+    directory in `datapath`). Loading the language data is the slowest part
+    of running the `tesseract` program, so we keep engines loaded for re-use
+    by later calls to `ocr` with the same parameters.
+    """
+
+    # Tesseract's OEM_DEFAULT
+    _OCR_ENGINE_MODE = 3
+
+    def __init__(self, lang, datapath=None, configs=()):
+        self.lang = lang
+        self._lib = _load_libtesseract()
+        self._lock = threading.Lock()
+        self._handle = self._lib.TessBaseAPICreate()
+        c_configs = (ctypes.c_char_p * len(configs))(*configs)
+        if self._lib.TessBaseAPIInit1(
+                self._handle, datapath, lang, self._OCR_ENGINE_MODE,
+                c_configs, len(configs)) != 0:
+            self._lib.TessBaseAPIDelete(self._handle)
+            self._handle = None
+            raise RuntimeError(
+                "libtesseract failed to load language '%s'" % lang)
+
+    def __del__(self):
+        if getattr(self, "_handle", None):
+            self._lib.TessBaseAPIEnd(self._handle)
+            self._lib.TessBaseAPIDelete(self._handle)
+            self._handle = None
+
+    def recognise(self, image, mode):
+        """Returns the text (UTF-8 encoded) in `image`, a BGR image."""
+        # The tesseract program reads our PNG files as RGB:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        with self._lock:
+            self._lib.TessBaseAPISetPageSegMode(self._handle, mode)
+            self._lib.TessBaseAPISetImage(
+                self._handle, image.ctypes.data, image.shape[1],
+                image.shape[0], 3, image.strides[0])
+            text = self._lib.TessBaseAPIGetUTF8Text(self._handle)
+            if not text:
+                raise RuntimeError("libtesseract failed to recognise text")
+            try:
+                return ctypes.string_at(text)
+            finally:
+                self._lib.TessDeleteText(text)
+
+
+# Tesseract engines that have loaded their language data, in an `_LRUCache`
+# keyed by `_tesseract_key`. An engine can only read one image at a time, so
+# each thread (see `ocr_many`) has its own engines.
+_tesseract_engines = threading.local()
+
+
+def _get_tesseract_engine(lang, config, user_patterns, user_words):
+    engines = getattr(_tesseract_engines, "cache", None)
+    if engines is None:
+        engines = _tesseract_engines.cache = _LRUCache(maxsize=4)
+    key = _tesseract_key(lang, config, user_patterns, user_words)
+    engine = engines.get(key)
+    if engine is None:
+        debug("Loading tesseract engine for language '%s'" % lang)
+        if config or user_patterns or user_words:
+            prefix, configs = _prepared_tessdata(
+                lang, config, user_patterns, user_words)
+            engine = _TesseractEngine(lang, prefix, configs)
+        else:
+            engine = _TesseractEngine(lang)
+        engines[key] = engine
+    return engine
+
+
+def _tidy_ocr_text(text):
+    return text.decode('utf-8').strip().translate(_ocr_transtab)
 
 
 def ocr(frame=None, region=None, mode=OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD,
@@ -959,28 +1704,131 @@ def ocr(frame=None, region=None, mode=OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD,
       for information on the format of the patterns:
       http://tesseract-ocr.googlecode.com/svn/trunk/doc/tesseract.1.html#_config_files_and_augmenting_with_user_data
     """
+    global _last_ocr
+    signature = None
+    args = (region, mode, lang, dict(tesseract_config or {}),
+            list(tesseract_user_words or []),
+            list(tesseract_user_patterns or []))
     if frame is None:
         frame = _display.get_sample()
+        last_signature, last_args, last_text = _last_ocr
+        unchanged, signature = _display.frame_dedup.check(
+            frame, last_signature if last_args == args else None)
+        if unchanged:
+            _display.frame_dedup.reused()
+            debug(u"OCR in region %s read '%s' (frame unchanged)." % (
+                region, last_text))
+            return last_text
 
     text, region = _tesseract(
         frame, region, mode, lang, config=tesseract_config,
         user_patterns=tesseract_user_patterns, user_words=tesseract_user_words)
-    text = text.decode('utf-8').strip().translate(_ocr_transtab)
+    text = _tidy_ocr_text(text)
     debug(u"OCR in region %s read '%s'." % (region, text))
+    if signature is not None:
+        _last_ocr = (signature, args, text)
     return text
 
 
-def frames(timeout_secs=None):
+def ocr_many(frame, regions, mode=OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD,
+             lang=None, tesseract_config=None, tesseract_user_words=None,
+             tesseract_user_patterns=None):
+    """Return the text present in each of several regions of the same video
+    frame, as a list of Unicode strings (in the same order as `regions`).
+
+    This is faster than calling `ocr` once for each region (for example to
+    read each cell of an EPG grid): The regions are read in parallel, using
+    `threads` threads from the `[ocr]` section of stbt.conf (by default one
+    per CPU core).
+
+    If `frame` is None, take a frame from the source video stream. A region
+    of None means the entire frame. The other parameters are the same as for
+    `ocr`, and apply to all of the regions.
+    """
+    if frame is None:
+        frame = _display.get_sample()
+
+    with _numpy_from_sample(frame, readonly=True) as f:
+        results = _parallel_map(
+            "ocr",
+            functools.partial(
+                _tesseract, f, mode=mode, lang=lang, config=tesseract_config,
+                user_patterns=tesseract_user_patterns,
+                user_words=tesseract_user_words),
+            list(regions))
+
+    texts = []
+    for text, region in results:
+        text = _tidy_ocr_text(text)
+        debug(u"OCR in region %s read '%s'." % (region, text))
+        texts.append(text)
+    return texts
+
+
+def frames(timeout_secs=None, since=None, analysis_fps=None,
+           every_nth_frame=None):
     """Generator that yields frames captured from the GStreamer pipeline.
 
     "timeout_secs" is in seconds elapsed, from the method call. Note that
     you can also simply stop iterating over the sequence yielded by this
     method.
 
+    "since" is a timestamp (as yielded by a previous call to `frames`, or the
+    `timestamp` of a `MatchResult` or `MotionResult`). If given, first yields
+    any frames newer than "since" that were already captured (while your
+    script was busy doing something else) and are still in the frame history,
+    then continues with new frames as they are captured. See
+    `global.frame_history_secs` in stbt.conf.
+
+    "analysis_fps" and "every_nth_frame" limit the frames yielded to at most
+    "analysis_fps" frames per second (0 means no limit) and to every
+    "every_nth_frame"th frame received from the source pipeline. The other
+    frames are skipped before they are copied or analysed, so this limits
+    the CPU used by slow analysis. The defaults are read from
+    `global.analysis_fps` and `global.every_nth_frame` in stbt.conf. The same
+    parameters are accepted by `detect_match`, `detect_matches` and
+    `detect_motion`.
+
     Returns an (image, timestamp) tuple for every frame captured, where
     "image" is in OpenCV format.
     """
-    return _display.frames(timeout_secs)
+    return _display.frames(
+        timeout_secs, since=since, analysis_fps=analysis_fps,
+        every_nth_frame=every_nth_frame)
+
+
+class FrameStatistics(namedtuple(
+        'FrameStatistics',
+        'received dropped skipped analysed age_secs max_age_secs')):
+    """
+    * `received`: The number of video frames received from the source
+      pipeline.
+    * `dropped`: The number of frames that were dropped, without being
+      analysed, because the test script was busy (see `global.frame_policy`
+      in stbt.conf).
+    * `skipped`: The number of frames that were skipped because of
+      `analysis_fps` or `every_nth_frame` (see `frames`).
+    * `analysed`: The number of frames given to `frames`, `detect_match`,
+      `detect_motion`, etc.
+    * `age_secs`: How old the most recently analysed frame was (in seconds,
+      according to the pipeline clock) when its analysis started. None if no
+      frames have been analysed yet.
+    * `max_age_secs`: The largest `age_secs` so far.
+    """
+    pass
+
+
+def frame_statistics():
+    """Returns a `FrameStatistics` with the number of video frames that have
+    been received, dropped and analysed so far, and how old the frames were
+    when they were analysed.
+
+    Use this to check that your test rig keeps up with the video, and how
+    much delay there is between something appearing on the screen and your
+    test script seeing it. The statistics are also logged at the end of each
+    test run (with `stbt run -v`).
+    """
+    return _display.frame_statistics()
 
 
 def save_frame(image, filename):
@@ -998,6 +1846,25 @@ def get_frame():
         return frame.copy()
 
 
+def save_flight_recording(filename=None):
+    """Writes the last few seconds of the output video to the specified file.
+
+    Only available when the flight recorder is enabled, by setting
+    `run.flight_recorder_secs` in stbt.conf and saving video with
+    `--save-video`: Instead of recording the whole test run, the last
+    `flight_recorder_secs` seconds of video are kept in memory, and
+    `stbt run` writes them to the `--save-video` file (or `filename`) only if
+    the test fails. You can call this function to save the video at other
+    times.
+
+    Returns True if the video was written; False if the flight recorder is
+    disabled or hasn't recorded anything yet.
+    """
+    if _display is None:
+        return False
+    return _display.save_flight_recording(filename)
+
+
 def is_screen_black(frame, mask=None, threshold=None):
     """Check for the presence of a black screen in a video frame.
 
@@ -1131,6 +1998,28 @@ class MotionTimeout(UITestFailure):
             self.timeout_secs)
 
 
+class StableTimeout(UITestFailure):
+    """
+    * `screenshot`: An OpenCV image from the source video when
+      `wait_for_stable` timed out.
+    * `mask`: Filename of the mask that was used (see `wait_for_stable`).
+    * `timeout_secs`: Number of seconds that `wait_for_stable` waited.
+    * `stable_secs`: How long the screen had to stay still.
+    """
+    def __init__(self, screenshot, mask, timeout_secs, stable_secs):
+        super(StableTimeout, self).__init__()
+        self.screenshot = screenshot
+        self.mask = mask
+        self.timeout_secs = timeout_secs
+        self.stable_secs = stable_secs
+
+    def __str__(self):
+        return ("Screen didn't stay still%s for %g seconds within %g "
+                "seconds." % (
+                    " (with mask '%s')" % self.mask if self.mask else "",
+                    self.stable_secs, self.timeout_secs))
+
+
 class ConfigurationError(UITestError):
     pass
 
@@ -1208,6 +2097,10 @@ def init_run(
 def teardown_run():
     if _display:
         _display.teardown()
+    _flush_debug_images()
+    if _ocr_cache.hits or _ocr_cache.misses:
+        debug("teardown: OCR cache: %s" % _ocr_cache.stats())
+    _remove_prepared_tessdata()
 
 
 # Internal
@@ -1226,6 +2119,10 @@ else:
 _display = None
 _control = None
 
+# (frame signature, arguments, text) of the last `ocr` of a live video frame,
+# for re-use when the frame hasn't changed. See `_FrameDeduplicator`.
+_last_ocr = (None, None, None)
+
 _config = None
 
 
@@ -1312,14 +2209,26 @@ def _gst_sample_make_writable(sample):
     if sample.get_buffer().mini_object.is_writable():
         return sample
     else:
-        return Gst.Sample.new(
-            sample.get_buffer().copy_region(
-                Gst.BufferCopyFlags.FLAGS | Gst.BufferCopyFlags.TIMESTAMPS |
-                Gst.BufferCopyFlags.META | Gst.BufferCopyFlags.MEMORY, 0,
-                sample.get_buffer().get_size()),
-            sample.get_caps(),
-            sample.get_segment(),
-            sample.get_info())
+        return _gst_sample_copy(sample)
+
+
+def _gst_sample_copy(sample):
+    return Gst.Sample.new(
+        sample.get_buffer().copy_region(
+            Gst.BufferCopyFlags.FLAGS | Gst.BufferCopyFlags.TIMESTAMPS |
+            Gst.BufferCopyFlags.META | Gst.BufferCopyFlags.MEMORY, 0,
+            sample.get_buffer().get_size()),
+        sample.get_caps(),
+        sample.get_segment(),
+        sample.get_info())
+
+
+def _sample_shape(sample):
+    """The shape that `_numpy_from_sample` would give the sample's image,
+    without mapping the buffer.
+    """
+    s = sample.get_caps().get_structure(0)
+    return (s.get_value('height'), s.get_value('width'), 3)
 
 
 @contextmanager
@@ -1402,6 +2311,214 @@ def _test_that_dimensions_of_array_are_according_to_caps():
         assert a.shape == (3, 4, 3)
 
 
+def _test_that_matchresult_only_copies_the_frame_when_used():
+    s = Gst.Sample.new(Gst.Buffer.new_wrapped(
+        "row 1 4 px  row 2 4 px  row 3 4 px  "),
+        Gst.Caps.from_string("video/x-raw,format=BGR,width=4,height=3"),
+        None, None)
+    r = MatchResult(0, True, Region(0, 0, 1, 1), 1.0, s, "template.png")
+    assert "frame=4x3x3" in str(r)
+    assert r._frame is None  # pylint: disable=W0212
+    assert r.frame.shape == (3, 4, 3)
+    assert r.frame[0, 0, 0] == ord("r")
+
+
+class _FrameDeduplicator(object):
+    """Tells the analysis functions (`detect_match`, `detect_motion`, `ocr`)
+    when a video frame is unchanged from the last frame they analysed, so that
+    they can re-use their previous result instead of analysing the frame
+    again.
+
+    Frames are compared by a signature: A hash of a thumbnail of the frame,
+    downsampled by `scale` in each dimension. Computing it is cheap compared
+    to the analysis that it saves. Enabled by `global.frame_dedup` in
+    stbt.conf.
+    """
+
+    def __init__(self, enabled, scale=4):
+        self.enabled = enabled
+        self.scale = scale
+        self.frames_checked = 0
+        self.frames_reused = 0
+        self._last_sample = None
+        self._last_signature = None
+
+    def signature(self, sample):
+        """Returns the signature of `sample`, or None if deduplication is
+        disabled. The signature of the most recent sample is cached, so
+        several analysis functions looking at the same sample only compute it
+        once.
+        """
+        if not self.enabled:
+            return None
+        if sample is not self._last_sample:
+            with _numpy_from_sample(sample, readonly=True) as frame:
+                thumbnail = cv2.resize(
+                    frame, (max(1, frame.shape[1] // self.scale),
+                            max(1, frame.shape[0] // self.scale)),
+                    interpolation=cv2.INTER_AREA)
+            self._last_sample = sample
+            self._last_signature = hashlib.sha1(thumbnail.data).digest()
+        return self._last_signature
+
+    def check(self, sample, previous_signature):
+        """Returns `(unchanged, signature)`: `unchanged` is True if `sample`
+        has the same signature as `previous_signature` (the signature of the
+        last frame that the caller analysed).
+        """
+        signature = self.signature(sample)
+        if signature is None:
+            return False, None
+        self.frames_checked += 1
+        return signature == previous_signature, signature
+
+    def reused(self):
+        """The caller calls this when it re-uses its previous result for an
+        unchanged frame (instead of analysing the frame again).
+        """
+        self.frames_reused += 1
+        ddebug("Frame unchanged; re-using previous result (%s)" % self.stats())
+
+    def stats(self):
+        return "re-used results for %d of %d frames (%d%%)" % (
+            self.frames_reused, self.frames_checked,
+            100 * self.frames_reused // max(1, self.frames_checked))
+
+
+class _FrameHistory(object):
+    """The most recent video frames, so that `frames(since=...)` can look
+    back at frames that were captured while the test script was busy.
+
+    Keeps at most `max_frames` frames, spanning at most `max_secs` seconds,
+    using at most `max_bytes` bytes. A limit of 0 means no limit, except that
+    the history is disabled if both `max_frames` and `max_secs` are 0.
+    Configured by `global.frame_history_*` in stbt.conf.
+    """
+
+    def __init__(self, max_secs=0, max_frames=0, max_bytes=0):
+        self.max_secs = max_secs
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.enabled = max_secs > 0 or max_frames > 0
+        self.lock = threading.Lock()
+        self.samples = deque()
+        self.size = 0
+
+    def add(self, frame_number, sample):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.samples.append((frame_number, sample))
+            self.size += sample.get_buffer().get_size()
+            newest = sample.get_buffer().pts
+            while len(self.samples) > 1 and (
+                    (self.max_frames and
+                     len(self.samples) > self.max_frames) or
+                    (self.max_secs and
+                     newest - self.samples[0][1].get_buffer().pts >
+                     self.max_secs * 1e9) or
+                    (self.max_bytes and self.size > self.max_bytes)):
+                _, oldest = self.samples.popleft()
+                self.size -= oldest.get_buffer().get_size()
+
+    def since(self, timestamp):
+        """Returns `(frame_number, sample)` for each sample newer than
+        `timestamp`, oldest first.
+        """
+        with self.lock:
+            samples = list(self.samples)
+        if samples and samples[0][1].get_buffer().pts > timestamp:
+            debug("Frame history doesn't go back to %d (oldest frame: %d)" % (
+                timestamp, samples[0][1].get_buffer().pts))
+        return [(n, x) for n, x in samples if x.get_buffer().pts > timestamp]
+
+
+def _test_that_frame_history_is_limited():
+    def sample(timestamp):
+        buf = Gst.Buffer.new_wrapped(
+            numpy.zeros((2, 2, 3), dtype=numpy.uint8).flatten())
+        buf.pts = timestamp * 1000000000
+        return Gst.Sample.new(buf, Gst.Caps.from_string(
+            'video/x-raw,format=BGR,width=2,height=2'), None, None)
+
+    def timestamps(history, since=-1):
+        return [x.get_buffer().pts // 1000000000
+                for _, x in history.since(since)]
+
+    disabled = _FrameHistory()
+    disabled.add(1, sample(0))
+    assert timestamps(disabled) == []
+
+    by_frames = _FrameHistory(max_frames=3)
+    by_secs = _FrameHistory(max_secs=2)
+    by_bytes = _FrameHistory(max_frames=100, max_bytes=4 * 12)
+    for t in range(10):
+        for history in [by_frames, by_secs, by_bytes]:
+            history.add(t + 1, sample(t))
+    assert timestamps(by_frames) == [7, 8, 9]
+    assert timestamps(by_secs) == [7, 8, 9]
+    assert timestamps(by_bytes) == [6, 7, 8, 9]
+    assert timestamps(by_bytes, since=7 * 1000000000) == [8, 9]
+
+
+class _FlightRecorder(object):
+    """Keeps the last `secs` seconds of the encoded output video in memory,
+    so that it is only written to disk when it is needed (for example when
+    the test fails). Enabled by `run.flight_recorder_secs` in stbt.conf.
+
+    The encoded frames are kept in groups that each start with a keyframe, so
+    that the video we write can always be decoded.
+    """
+
+    def __init__(self, secs):
+        self.secs = secs
+        self.lock = threading.Lock()
+        self.groups = deque()
+
+    def on_new_sample(self, appsink):
+        sample = appsink.emit("pull-sample")
+        buf = sample.get_buffer()
+        with self.lock:
+            if not buf.mini_object.flags & Gst.BufferFlags.DELTA_UNIT:
+                self.groups.append([])
+            if self.groups:
+                self.groups[-1].append(sample)
+                while (len(self.groups) > 1 and
+                       buf.pts - self.groups[1][0].get_buffer().pts >=
+                       self.secs * 1e9):
+                    self.groups.popleft()
+        return Gst.FlowReturn.OK
+
+    def save(self, filename):
+        """Writes the recorded video to `filename` (in WebM format). Returns
+        False if there is nothing to write yet.
+        """
+        with self.lock:
+            samples = [sample for group in self.groups for sample in group]
+        if not samples:
+            return False
+
+        pipeline = Gst.parse_launch(
+            "appsrc name=appsrc format=time ! webmmux ! filesink name=filesink")
+        pipeline.get_by_name("filesink").set_property("location", filename)
+        appsrc = pipeline.get_by_name("appsrc")
+        appsrc.props.caps = samples[0].get_caps()
+        pipeline.set_state(Gst.State.PLAYING)
+        for sample in samples:
+            appsrc.emit("push-buffer", sample.get_buffer())
+        appsrc.emit("end-of-stream")
+        message = pipeline.get_bus().timed_pop_filtered(
+            10 * 1000000000, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        pipeline.set_state(Gst.State.NULL)
+        if message is None or message.type == Gst.MessageType.ERROR:
+            warn("Failed to write the flight recording to '%s'" % filename)
+            return False
+        debug("Saved the last %.1fs of video to '%s'" % (
+            (samples[-1].get_buffer().pts - samples[0].get_buffer().pts) / 1e9,
+            filename))
+        return True
+
+
 class Display(object):
     def __init__(self, user_source_pipeline, user_sink_pipeline,
                  save_video,
@@ -1409,32 +2526,133 @@ class Display(object):
                  transformation_pipeline='identity'):
         self.novideo = False
         self.lock = threading.RLock()  # Held by whoever is consuming frames
-        self.last_sample = Queue.Queue(maxsize=1)
+        frame_policy = get_config('global', 'frame_policy')
+        if frame_policy == "latest":
+            backlog = 1
+        elif frame_policy == "in-order":
+            backlog = get_config('global', 'frame_backlog', type_=int)
+            if backlog < 1:
+                raise ConfigurationError(
+                    "Invalid value '%d' for 'global.frame_backlog' (must be "
+                    "at least 1)" % backlog)
+        else:
+            raise ConfigurationError(
+                "Invalid value '%s' for 'global.frame_policy' (must be "
+                "'latest' or 'in-order')" % frame_policy)
+        self.last_sample = Queue.Queue(maxsize=backlog)
         self.source_pipeline = None
         self.start_timestamp = None
         self.underrun_timeout = None
         self.video_debug = []
+        self.overlays = []
+        self.frame_copies = 0
+        self.frame_copies_since = time.time()
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.frames_skipped = 0
+        self.frames_analysed = 0
+        self.frame_age = None
+        self.max_frame_age = None
+        self.frame_number = None
         self.tearing_down = False
 
         self.restart_source_enabled = restart_source
+        self.source_eos = threading.Event()
+        self.recording = None
+        self.recording_segments = 0
+        self.flight_recorder = None
+        self.flight_recording_filename = None
+        self.frame_history = _FrameHistory(
+            max_secs=get_config('global', 'frame_history_secs', type_=float),
+            max_frames=get_config('global', 'frame_history_frames', type_=int),
+            max_bytes=get_config(
+                'global', 'frame_history_max_mb', type_=float) * 1024 * 1024)
+        self.frame_dedup = _FrameDeduplicator(
+            enabled=(get_config('global', 'frame_dedup').lower() in
+                     ("1", "yes", "true", "on")))
 
         appsink = (
             "appsink name=appsink max-buffers=1 drop=false sync=true "
             "emit-signals=true "
             "caps=video/x-raw,format=BGR")
-        self.source_pipeline_description = " ! ".join([
+        save_video_mode = get_config('run', 'save_video_mode')
+        if save_video_mode not in ("encode", "passthrough"):
+            raise ConfigurationError(
+                "Invalid value '%s' for 'run.save_video_mode' (must be "
+                "'encode' or 'passthrough')" % save_video_mode)
+        if save_video and save_video_mode == "passthrough":
+            # Record the stream from the user's source pipeline as-is, before
+            # it is decoded, instead of re-encoding our output video.
+            self.recording = save_video
+            save_video = None
+            debug("Saving video (passthrough) to '%s'" % self.recording)
+
+        flight_recorder_secs = get_config(
+            'run', 'flight_recorder_secs', type_=float)
+        # The flight recorder only replaces "encode" mode `save_video`; we
+        # don't pay for encoding the output video if it isn't being saved.
+        if flight_recorder_secs > 0 and save_video:
+            self.flight_recorder = _FlightRecorder(flight_recorder_secs)
+            if not save_video.endswith(".webm"):
+                save_video += ".webm"
+            self.flight_recording_filename = save_video
+        elif flight_recorder_secs > 0 and self.recording:
+            warn("Not using the flight recorder because the video is "
+                 "being saved in passthrough mode")
+
+        source_elements = [
             user_source_pipeline,
             'queue name=_stbt_user_data_queue max-size-buffers=0 '
-            '    max-size-bytes=0 max-size-time=10000000000',
+            '    max-size-bytes=0 max-size-time=10000000000']
+        if self.recording:
+            source_elements.append("tee name=_stbt_recording_tee")
+        source_elements += [
             "decodebin",
             'queue name=_stbt_raw_frames_queue max-size-buffers=2',
             'videoconvert',
             'video/x-raw,format=BGR',
             transformation_pipeline,
-            appsink])
+            appsink]
+        self.source_pipeline_description = " ! ".join(source_elements)
+        if self.recording:
+            # The filesink's location is set in `create_source_pipeline`.
+            self.source_pipeline_description += (
+                " _stbt_recording_tee. ! queue ! %s ! "
+                "filesink name=_stbt_recording_filesink" %
+                get_config('run', 'passthrough_mux'))
         self.create_source_pipeline()
 
-        if save_video:
+        self.headless = _is_headless(
+            get_config('global', 'headless'), user_sink_pipeline,
+            save_video or self.flight_recorder)
+        if self.headless:
+            debug("Running headless: Not creating a sink pipeline")
+            self.sink_pipeline = None
+            self.appsrc = None
+        else:
+            self.create_sink_pipeline(user_sink_pipeline, save_video)
+
+        debug("source pipeline: %s" % self.source_pipeline_description)
+
+        self.source_pipeline.set_state(Gst.State.PLAYING)
+        if self.sink_pipeline:
+            self.sink_pipeline.set_state(Gst.State.PLAYING)
+
+        self.mainloop_thread = threading.Thread(target=_mainloop.run)
+        self.mainloop_thread.daemon = True
+        self.mainloop_thread.start()
+
+    def create_sink_pipeline(self, user_sink_pipeline, save_video):
+        if self.flight_recorder:
+            debug("Keeping the last %gs of video in the flight recorder" %
+                  self.flight_recorder.secs)
+            # Frequent keyframes, so that we can trim the recording finely.
+            video_pipeline = (
+                "t. ! queue leaky=downstream ! videoconvert ! "
+                "vp8enc cpu-used=6 min_quantizer=32 max_quantizer=32 "
+                "keyframe-max-dist=30 ! "
+                "appsink name=flight_recorder sync=false emit-signals=true")
+        elif save_video:
             if not save_video.endswith(".webm"):
                 save_video += ".webm"
             debug("Saving video to '%s'" % save_video)
@@ -1463,17 +2681,12 @@ class Display(object):
         sink_bus.connect("message::eos", self.on_eos_from_sink_pipeline)
         sink_bus.add_signal_watch()
         self.appsrc = self.sink_pipeline.get_by_name("appsrc")
+        if self.flight_recorder:
+            self.sink_pipeline.get_by_name("flight_recorder").connect(
+                "new-sample", self.flight_recorder.on_new_sample)
 
-        debug("source pipeline: %s" % self.source_pipeline_description)
         debug("sink pipeline: %s" % sink_pipeline_description)
 
-        self.source_pipeline.set_state(Gst.State.PLAYING)
-        self.sink_pipeline.set_state(Gst.State.PLAYING)
-
-        self.mainloop_thread = threading.Thread(target=_mainloop.run)
-        self.mainloop_thread.daemon = True
-        self.mainloop_thread.start()
-
     def create_source_pipeline(self):
         self.source_pipeline = Gst.parse_launch(
             self.source_pipeline_description)
@@ -1486,6 +2699,20 @@ class Display(object):
         source_bus.add_signal_watch()
         appsink = self.source_pipeline.get_by_name("appsink")
         appsink.connect("new-sample", self.on_new_sample)
+        self.source_eos.clear()
+
+        if self.recording:
+            # Restarting the source: Write to a new file, instead of
+            # overwriting what we've recorded so far (or appending a second
+            # container header to it, which would corrupt e.g. Matroska).
+            filename = self.recording
+            if self.recording_segments > 0:
+                root, ext = os.path.splitext(self.recording)
+                filename = "%s.%d%s" % (root, self.recording_segments, ext)
+                debug("Saving video (passthrough) to '%s'" % filename)
+            self.source_pipeline.get_by_name(
+                "_stbt_recording_filesink").set_property("location", filename)
+            self.recording_segments += 1
 
         if self.restart_source_enabled:
             # Handle loss of video (but without end-of-stream event) from the
@@ -1504,11 +2731,18 @@ class Display(object):
             self.source_pipeline.get_by_name('appsink') \
                 .set_property('sync', False)
 
+    def save_flight_recording(self, filename=None):
+        if not self.flight_recorder:
+            return False
+        return self.flight_recorder.save(
+            filename or self.flight_recording_filename)
+
     def get_sample(self, timeout_secs=10):
         try:
             # Timeout in case no frames are received. This happens when the
             # Hauppauge HDPVR video-capture device loses video.
-            gst_sample = self.last_sample.get(timeout=timeout_secs)
+            frame_number, gst_sample = self.last_sample.get(
+                timeout=timeout_secs)
             self.novideo = False
         except Queue.Empty:
             self.novideo = True
@@ -1518,23 +2752,57 @@ class Display(object):
         if isinstance(gst_sample, Exception):
             raise UITestError(str(gst_sample))
 
+        self.frame_number = frame_number
         return gst_sample
 
-    def frames(self, timeout_secs=None):
-        for sample in self.gst_samples(timeout_secs=timeout_secs):
+    def frames(self, timeout_secs=None, since=None, analysis_fps=None,
+               every_nth_frame=None):
+        for sample in self.gst_samples(
+                timeout_secs=timeout_secs, since=since,
+                analysis_fps=analysis_fps, every_nth_frame=every_nth_frame):
             with _numpy_from_sample(sample, readonly=True) as frame:
                 copy = frame.copy()
             yield (copy, sample.get_buffer().pts)
 
-    def gst_samples(self, timeout_secs=None):
+    def gst_samples(self, timeout_secs=None, since=None, analysis_fps=None,
+                    every_nth_frame=None):
         self.start_timestamp = None
+        if analysis_fps is None:
+            analysis_fps = get_config('global', 'analysis_fps', type_=float)
+        if every_nth_frame is None:
+            every_nth_frame = get_config('global', 'every_nth_frame', type_=int)
+        if analysis_fps < 0 or every_nth_frame < 1:
+            raise ValueError(
+                "Invalid analysis_fps (%s) or every_nth_frame (%s)" % (
+                    analysis_fps, every_nth_frame))
+        last_analysed = None
 
         with self.lock:
+            # These have already been pushed to the sink pipeline (or
+            # skipped), so we don't push them again. New frames keep arriving
+            # while we yield these (and only the latest few are kept for
+            # `get_sample`), so we keep reading the history until we've
+            # caught up with it.
+            history = [] if since is None else self.frame_history.since(since)
+            while history:
+                for frame_number, sample in history:
+                    since = sample.get_buffer().pts
+                    if _skip_frame(frame_number, since, last_analysed,
+                                   analysis_fps, every_nth_frame):
+                        self.frames_skipped += 1
+                        continue
+                    last_analysed = since
+                    self.count_analysed(sample)
+                    yield sample
+                history = self.frame_history.since(since)
+
             while True:
                 ddebug("user thread: Getting sample at %s" % time.time())
                 sample = self.get_sample(max(10, timeout_secs))
                 ddebug("user thread: Got sample at %s" % time.time())
                 timestamp = sample.get_buffer().pts
+                if since is not None and timestamp <= since:
+                    continue  # We've already seen it in the history
 
                 if timeout_secs is not None:
                     if not self.start_timestamp:
@@ -1545,15 +2813,48 @@ class Display(object):
                             timeout_secs * 1e9))
                         return
 
-                sample = _gst_sample_make_writable(sample)
+                if _skip_frame(self.frame_number, timestamp, last_analysed,
+                               analysis_fps, every_nth_frame):
+                    ddebug("user thread: Skipping frame %d (timestamp=%d)" % (
+                        self.frame_number, timestamp))
+                    self.frames_skipped += 1
+                    self.push_sample(sample)
+                    continue
+                last_analysed = timestamp
+                self.count_analysed(sample)
+
                 try:
                     yield sample
                 finally:
                     self.push_sample(sample)
 
+    def count_analysed(self, sample):
+        """Records that `sample` is being analysed, and how old it is: The
+        time between its timestamp and the current running time of the
+        source pipeline's clock.
+        """
+        self.frames_analysed += 1
+        pipeline = self.source_pipeline
+        clock = pipeline and pipeline.get_clock()
+        if clock is None:
+            return
+        running_time = clock.get_time() - pipeline.get_base_time()
+        self.frame_age = (running_time - sample.get_buffer().pts) / 1e9
+        self.max_frame_age = max(self.max_frame_age, self.frame_age)
+        ddebug("user thread: Analysing frame %s (age %.3fs)" % (
+            self.frame_number, self.frame_age))
+
+    def frame_statistics(self):
+        return FrameStatistics(
+            received=self.frames_received, dropped=self.frames_dropped,
+            skipped=self.frames_skipped, analysed=self.frames_analysed,
+            age_secs=self.frame_age, max_age_secs=self.max_frame_age)
+
     def on_new_sample(self, appsink):
         sample = appsink.emit("pull-sample")
-        self.tell_user_thread(sample)
+        self.frames_received += 1
+        self.frame_history.add(self.frames_received, sample)
+        self.tell_user_thread(sample, self.frames_received)
         if self.lock.acquire(False):  # non-blocking
             try:
                 self.push_sample(sample)
@@ -1561,7 +2862,7 @@ class Display(object):
                 self.lock.release()
         return Gst.FlowReturn.OK
 
-    def tell_user_thread(self, sample_or_exception):
+    def tell_user_thread(self, sample_or_exception, frame_number=None):
         # `self.last_sample` (a synchronised Queue) is how we communicate from
         # this thread (the GLib main loop) to the main application thread
         # running the user's script. Note that only this thread writes to the
@@ -1575,19 +2876,49 @@ class Display(object):
                    (sample_or_exception.get_buffer().pts,
                     self.last_sample.qsize()))
 
-        # Drop old frame
-        try:
-            self.last_sample.get_nowait()
-        except Queue.Empty:
-            pass
-
-        self.last_sample.put_nowait(sample_or_exception)
+        # Drop the oldest frame if the user thread hasn't kept up. With
+        # `global.frame_policy = latest` the Queue only holds one frame.
+        while True:
+            try:
+                self.last_sample.put_nowait((frame_number, sample_or_exception))
+                break
+            except Queue.Full:
+                try:
+                    dropped_number, dropped = self.last_sample.get_nowait()
+                except Queue.Empty:
+                    continue
+                if not isinstance(dropped, Exception):
+                    self.frames_dropped += 1
+                    ddebug("glib thread: dropped frame %d (timestamp=%s)" % (
+                        dropped_number, dropped.get_buffer().pts))
 
     def draw_text(self, text, duration_secs):
         """Draw the specified text on the output video."""
+        if self.headless:
+            return
         self.video_debug.append((text, duration_secs, None))
 
+    def draw_region(self, region, colour):
+        """Draw a rectangle around `region` on the next frame of the output
+        video.
+        """
+        self.draw_overlay(lambda img: cv2.rectangle(
+            img, (region.x, region.y), (region.right, region.bottom), colour,
+            thickness=3))
+
+    def draw_overlay(self, draw):
+        """Call `draw(img)` to draw on the next frame of the output video.
+
+        The analysis functions get a read-only view of each frame; the frame
+        is only copied (to draw on) if there is something to draw.
+        """
+        if self.headless:
+            return
+        self.overlays.append(draw)
+
     def push_sample(self, sample):
+        if self.headless:
+            return
         timestamp = sample.get_buffer().pts
         for text, duration, timeout in list(self.video_debug):
             if timeout is None:
@@ -1596,10 +2927,16 @@ class Display(object):
                 self.video_debug.append((text, duration, timeout))
             if timestamp > timeout:
                 self.video_debug.remove((text, duration, timeout))
+        overlays, self.overlays = self.overlays, []
 
-        if len(self.video_debug) > 0:
-            sample = _gst_sample_make_writable(sample)
+        if len(self.video_debug) > 0 or len(overlays) > 0:
+            # Draw on a copy: The user's script may still be using `sample`
+            # (for example in a `MatchResult`).
+            sample = _gst_sample_copy(sample)
+            self.frame_copies += 1
             with _numpy_from_sample(sample) as img:
+                for draw in overlays:
+                    draw(img)
                 for i in range(len(self.video_debug)):
                     text, _, _ = self.video_debug[len(self.video_debug) - i - 1]
                     cv2.putText(
@@ -1607,6 +2944,15 @@ class Display(object):
                         cv2.FONT_HERSHEY_TRIPLEX, fontScale=1.0,
                         color=(255, 255, 255))
 
+        now = time.time()
+        if now - self.frame_copies_since >= 1:
+            if self.frame_copies:
+                debug("Copied %d frames for the output video's overlays in "
+                      "%.1fs" % (self.frame_copies,
+                                 now - self.frame_copies_since))
+            self.frame_copies = 0
+            self.frame_copies_since = now
+
         self.appsrc.props.caps = sample.get_caps()
         self.appsrc.emit("push-buffer", sample.get_buffer())
 
@@ -1627,7 +2973,9 @@ class Display(object):
         warn("Warning: %s: %s\n%s\n" % (err, err.message, dbg))
 
     def on_eos_from_source_pipeline(self, _bus, _message):
-        if not self.tearing_down:
+        if self.tearing_down:
+            self.source_eos.set()
+        else:
             warn("Got EOS from source pipeline")
             self.restart_source()
 
@@ -1684,6 +3032,9 @@ class Display(object):
 
     def teardown(self):
         self.tearing_down = True
+        if self.frame_dedup.enabled:
+            debug("teardown: Frame deduplication %s" % self.frame_dedup.stats())
+        debug("teardown: %s" % str(self.frame_statistics()))
         self.source_pipeline, source = None, self.source_pipeline
         if source:
             for elem in gst_iterate(source.iterate_sources()):
@@ -1691,9 +3042,16 @@ class Display(object):
             if not self.appsink_await_eos(
                     source.get_by_name('appsink'), timeout=10):
                 debug("teardown: Source pipeline did not teardown gracefully")
+            if self.recording and not self.source_eos.wait(10):
+                # Give the muxer a chance to finalise the recording.
+                debug("teardown: Recording of the source video did not "
+                      "finish gracefully")
             source.set_state(Gst.State.NULL)
             source = None
-        if not self.novideo:
+        if self.headless:
+            _mainloop.quit()
+            self.mainloop_thread.join(10)
+        elif not self.novideo:
             debug("teardown: Sending eos")
             self.appsrc.emit("end-of-stream")
             self.mainloop_thread.join(10)
@@ -1701,6 +3059,69 @@ class Display(object):
                 "is still alive!" if self.mainloop_thread.isAlive() else "ok"))
 
 
+def _skip_frame(frame_number, timestamp, last_analysed, analysis_fps,
+                every_nth_frame):
+    """Whether the analysis functions should skip this video frame, to limit
+    them to `analysis_fps` frames per second and to every `every_nth_frame`th
+    frame (see `frames`). `frame_number` counts the frames received from the
+    source pipeline; `last_analysed` is the timestamp of the last frame that
+    wasn't skipped.
+
+    The decision only depends on the frame numbers and timestamps, so it's
+    the same however long the analysis takes. `analysis_fps` allows one frame
+    in each 1/`analysis_fps` second interval:
+
+    >>> [n for n in range(1, 9) if not _skip_frame(n, 0, None, 0, 3)]
+    [3, 6]
+    >>> analysed, frame_duration = [0], 40000000  # 25 frames per second
+    >>> for n in range(1, 12):
+    ...     if not _skip_frame(n, n * frame_duration,
+    ...                        analysed[-1] * frame_duration, 10, 1):
+    ...         analysed.append(n)
+    >>> analysed
+    [0, 3, 5, 8, 10]
+    """
+    if every_nth_frame > 1 and frame_number % every_nth_frame != 0:
+        return True
+    if analysis_fps > 0 and last_analysed is not None:
+        return (int(timestamp * analysis_fps // 1e9) ==
+                int(last_analysed * analysis_fps // 1e9))
+    return False
+
+
+def _is_headless(setting, sink_pipeline, save_video):
+    """Whether to run without a sink pipeline, according to the
+    `global.headless` configuration `setting` ("auto", "True" or "False").
+
+    >>> _is_headless("auto", "fakesink sync=false", "")
+    True
+    >>> _is_headless("auto", "fakesink", "video.webm")
+    False
+    >>> _is_headless("auto", "xvimagesink sync=false", "")
+    False
+    >>> _is_headless("False", "fakesink", "")
+    False
+    >>> _is_headless("True", "xvimagesink", "")
+    True
+    """
+    setting = setting.lower()
+    if setting == "auto":
+        elements = sink_pipeline.split()
+        return (not save_video and "!" not in sink_pipeline and
+                elements[:1] == ["fakesink"])
+    elif setting in ("1", "yes", "true", "on"):
+        if save_video:
+            warn("Not running headless because the video is being saved")
+            return False
+        return True
+    elif setting in ("0", "no", "false", "off"):
+        return False
+    else:
+        raise ConfigurationError(
+            "Invalid value '%s' for 'global.headless' (must be 'auto', "
+            "'True' or 'False')" % setting)
+
+
 class GObjectTimeout(object):
     """Responsible for setting a timeout in the GTK main loop."""
     def __init__(self, timeout_secs, handler, *args):
@@ -1722,30 +3143,44 @@ class GObjectTimeout(object):
 _BGR_CAPS = Gst.Caps.from_string('video/x-raw,format=BGR')
 
 
-def _match(image, template, match_parameters, template_name):
-    if any(image.shape[x] < template.shape[x] for x in (0, 1)):
+def _match(image, template, match_parameters, template_name,
+           image_pyramid=None, region=None):
+    """Search for `template` within `region` of `image`.
+
+    If `image_pyramid` is given, it must be the pyramid of the `region` of
+    `image` (not of the whole `image`). The returned `Region` is relative to
+    the top left of the whole `image`.
+
+    `image` can be a BGR or a grayscale image. With
+    `MatchParameters(colour=False)` a BGR `image` is converted to grayscale
+    here; callers matching several templates against the same frame should
+    convert it once beforehand.
+    """
+    if not isinstance(template, Template):
+        template = Template(template)
+    region = _clip_region(region, image)
+    image = image[region.to_slice()]
+    if not match_parameters.colour and len(image.shape) == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if any(image.shape[x] < template.image.shape[x] for x in (0, 1)):
         raise ValueError("Source image must be larger than template image")
-    if any(template.shape[x] < 1 for x in (0, 1)):
-        raise ValueError("Template image must contain some data")
-    if template.shape[2] != 3:
-        raise ValueError("Template image must be 3 channel BGR")
-    if template.dtype != numpy.uint8:
-        raise ValueError("Template image must be 8-bits per channel")
 
     first_pass_matched, position, first_pass_certainty = _find_match(
-        image, template, match_parameters)
+        image, template, match_parameters, image_pyramid)
     matched = (
         first_pass_matched and
         _confirm_match(image, position, template, match_parameters))
 
-    region = Region(position.x, position.y,
-                    template.shape[1], template.shape[0])
+    match_region = Region(
+        region.x + position.x, region.y + position.y,
+        template.width, template.height)
 
     if _debug_level > 1:
         source_with_roi = image.copy()
         cv2.rectangle(
             source_with_roi,
-            (region.x, region.y), (region.right, region.bottom),
+            (position.x, position.y),
+            (position.x + template.width, position.y + template.height),
             (32, 0 if first_pass_matched else 255, 255),  # bgr
             thickness=1)
         _log_image(
@@ -1754,30 +3189,110 @@ def _match(image, template, match_parameters, template_name):
             template_name, matched, position,
             first_pass_matched, first_pass_certainty, match_parameters)
 
-    return matched, region, first_pass_certainty
+    return matched, match_region, first_pass_certainty
+
 
+def _match_or_track(images, search_region, image_pyramids, tracking, args):
+    """Search for a template within `search_region` of the frame (see
+    `_match`), but if `tracking` first look near where the template was found
+    in the previous frame.
 
-def _find_match(image, template, match_parameters):
+    `images` and `image_pyramids` are dicts with the colour (BGR) frame and
+    its pyramid under the key True, and the grayscale frame and its pyramid
+    under the key False (if needed).
+
+    `args` is a tuple of `(template, match_parameters, previous_result)` so
+    that this can be used with `_parallel_map`.
+    """
+    template, match_parameters, previous = args
+    image = images[match_parameters.colour]
+    image_pyramid = image_pyramids.get(match_parameters.colour)
+    if tracking and previous:
+        neighbourhood = _tracking_region(previous.region, search_region)
+        result = _match(
+            image, template, match_parameters, template.name,
+            region=neighbourhood)
+        ddebug("Tracking %s: %s near %s" % (
+            template.name, "found" if result[0] else "lost", previous.region))
+        if result[0]:
+            return result
+    return _match(
+        image, template, match_parameters, template.name, image_pyramid,
+        search_region)
+
+
+def _clip_region(region, image):
+    """Returns the part of `region` that lies within `image`, or the entire
+    `image` if `region` is None.
+
+    >>> _clip_region(Region(10, 10, 20, 20), numpy.zeros((20, 40, 3)))
+    Region(x=10, y=10, width=20, height=10)
+    >>> _clip_region(None, numpy.zeros((20, 40, 3)))
+    Region(x=0, y=0, width=40, height=20)
+    """
+    frame = Region(0, 0, image.shape[1], image.shape[0])
+    if region is None:
+        return frame
+    clipped = _intersect_regions(region, frame)
+    if clipped is None:
+        raise ValueError(
+            "Region %s is outside of the video frame %s" % (region, frame))
+    return clipped
+
+
+def _intersect_regions(a, b):
+    """Returns the region covered by both `a` and `b`, or None if they don't
+    overlap.
+
+    >>> _intersect_regions(Region(0, 0, 10, 10), Region(5, 5, 10, 10))
+    Region(x=5, y=5, width=5, height=5)
+    >>> _intersect_regions(Region(0, 0, 10, 10), Region(20, 20, 10, 10))
+    """
+    x, y = max(a.x, b.x), max(a.y, b.y)
+    right, bottom = min(a.right, b.right), min(a.bottom, b.bottom)
+    if right <= x or bottom <= y:
+        return None
+    return Region.from_extents(x, y, right, bottom)
+
+
+def _tracking_region(previous, search_region):
+    """The neighbourhood around the `previous` match to search first, when
+    tracking a match from frame to frame.
+    """
+    margin = get_config("match", "tracking_margin", type_=int)
+    return _intersect_regions(
+        Region(previous.x - margin, previous.y - margin,
+               previous.width + 2 * margin, previous.height + 2 * margin),
+        search_region)
+
+
+def _find_match(image, template, match_parameters, image_pyramid=None):
     """Search for `template` in the entire `image`.
 
     This searches the entire image, so speed is more important than accuracy.
     False positives are ok; we apply a second pass (`_confirm_match`) to weed
     out false positives.
 
+    `image_pyramid` is the pyramid of `image` with at least as many levels as
+    `template.pyramid`, if the caller has already built it (for example to
+    share it between several templates).
+
     http://docs.opencv.org/modules/imgproc/doc/object_detection.html
     http://opencv-code.com/tutorials/fast-template-matching-with-image-pyramid
     """
 
     log = functools.partial(_log_image, directory="stbt-debug/detect_match")
     log(image, "source")
-    log(template, "template")
-    ddebug("Original image %s, template %s" % (image.shape, template.shape))
+    log(template.image, "template")
+    ddebug("Original image %s, template %s" % (
+        image.shape, template.image.shape))
 
-    levels = get_config("match", "pyramid_levels", type_=int)
-    if levels <= 0:
-        raise ConfigurationError("'match.pyramid_levels' must be > 0")
-    template_pyramid = _build_pyramid(template, levels)
-    image_pyramid = _build_pyramid(image, len(template_pyramid))
+    if len(image.shape) == 2:
+        template_pyramid = template.gray_pyramid
+    else:
+        template_pyramid = template.pyramid
+    if image_pyramid is None:
+        image_pyramid = _build_pyramid(image, len(template_pyramid))
     roi_mask = None  # Initial region of interest: The whole image.
 
     for level in reversed(range(len(template_pyramid))):
@@ -1841,7 +3356,7 @@ def _match_template(image, template, match_parameters, roi_mask, level):
                 thickness=1)
         log(source_with_rois, log_prefix + "source_with_rois")
 
-    for roi in rois:
+    def search(roi):
         r = roi.expand(_Size(*template.shape[:2])).shrink(_Size(1, 1))
         ddebug("Level %d: Searching in %s" % (level, roi))
         cv2.matchTemplate(
@@ -1850,6 +3365,10 @@ def _match_template(image, template, match_parameters, roi_mask, level):
             method,
             matches_heatmap[roi.to_slice()])
 
+    # Each region of interest writes to its own part of `matches_heatmap` (see
+    # `_split_rois`), so we can search them in parallel.
+    _parallel_map("match", search, _split_rois(rois, _parallelism("match")))
+
     log(image, log_prefix + "source")
     log(template, log_prefix + "template")
     log(matches_heatmap, log_prefix + "source_matchtemplate")
@@ -1882,6 +3401,190 @@ def _match_template(image, template, match_parameters, roi_mask, level):
     return (matched, best_match_position, certainty, new_roi_mask)
 
 
+_thread_pools = {}  # config section => (threads, ThreadPool or None)
+_thread_pools_lock = threading.Lock()
+_pool_worker = threading.local()
+
+
+def _thread_pool(section):
+    """Returns `(threads, pool)`: The number of threads configured by
+    `threads` in the given section of stbt.conf, and the pool of that many
+    threads used by `_parallel_map` (None if `threads` is 1). The pool is
+    started the first time it is needed.
+    """
+    with _thread_pools_lock:
+        if section not in _thread_pools:
+            threads = get_config(section, "threads", type_=int)
+            if threads == 0:
+                threads = multiprocessing.cpu_count()
+            pool = None
+            if threads > 1:
+                debug("Starting %d %s threads" % (threads, section))
+                pool = ThreadPool(
+                    threads, initializer=setattr,
+                    initargs=(_pool_worker, "active", True))
+            _thread_pools[section] = (threads, pool)
+        return _thread_pools[section]
+
+
+def _parallelism(section):
+    """The number of threads that `_parallel_map(section, ...)` will use if
+    called now.
+
+    This is `threads` from that section of stbt.conf, except that we run
+    serially (in the calling thread) if called from one of the pools' own
+    threads (the pool would deadlock waiting for itself), or if template
+    matching while we're writing debug images (their filenames are numbered
+    sequentially).
+    """
+    if getattr(_pool_worker, "active", False):
+        return 1
+    if section == "match" and _debug_level > 1:
+        return 1
+    threads, _ = _thread_pool(section)
+    return max(threads, 1)
+
+
+def _parallel_map(section, function, items):
+    """Like `map`, but runs `function` on several `items` at once using a pool
+    of `threads` threads from the given section of stbt.conf ("match" or
+    "ocr"). OpenCV and Tesseract (whether the library or the program) run
+    without holding the GIL, so this can use several CPU cores.
+    """
+    if len(items) < 2 or _parallelism(section) == 1:
+        return map(function, items)
+    _, pool = _thread_pool(section)
+    return pool.map(function, items)
+
+
+def _split_rois(rois, n):
+    """Splits the regions of interest into at least `n` horizontal strips so
+    that `_parallel_map` can search them in parallel.
+
+    The bounding rectangles of separate contours can overlap, so overlapping
+    regions are merged first: Each strip writes to its own part of the
+    `matches_heatmap`.
+
+    >>> [(r.y, r.h) for r in _split_rois([_Rect(0, 0, 10, 10)], 3)]
+    [(0, 4), (4, 4), (8, 2)]
+    >>> len(_split_rois([_Rect(0, 0, 10, 10), _Rect(0, 20, 10, 1)], 2))
+    2
+    >>> _split_rois([_Rect(0, 0, 10, 10), _Rect(5, 5, 10, 10)], 1)
+    [_Rect(x=0, y=0, w=15, h=15)]
+    >>> [(r.y, r.h) for r in _split_rois(
+    ...     [_Rect(0, 0, 10, 10), _Rect(5, 5, 10, 10)], 3)]
+    [(0, 5), (5, 5), (10, 5)]
+    """
+    rois = _merge_overlapping_rois(rois)
+    if len(rois) >= n:
+        return rois
+    strips_per_roi = (n + len(rois) - 1) // len(rois)
+    out = []
+    for roi in rois:
+        height = (roi.h + strips_per_roi - 1) // strips_per_roi
+        for y in range(0, roi.h, height):
+            out.append(_Rect(roi.x, roi.y + y, roi.w, min(height, roi.h - y)))
+    return out
+
+
+def _merge_overlapping_rois(rois):
+    """Replaces any regions of interest that overlap with their union.
+
+    >>> _merge_overlapping_rois([
+    ...     _Rect(0, 0, 10, 10), _Rect(20, 0, 10, 10), _Rect(9, 9, 12, 2)])
+    [_Rect(x=0, y=0, w=30, h=11)]
+    >>> _merge_overlapping_rois([_Rect(0, 0, 10, 10), _Rect(10, 0, 10, 10)])
+    [_Rect(x=0, y=0, w=10, h=10), _Rect(x=10, y=0, w=10, h=10)]
+    """
+    out = []
+    for roi in rois:
+        i = 0
+        while i < len(out):
+            if roi.overlaps(out[i]):
+                # The union might overlap regions we've already checked.
+                roi = roi.union(out.pop(i))
+                i = 0
+            else:
+                i += 1
+        out.append(roi)
+    return out
+
+
+class _LRUCache(object):
+    """A dict-like cache that holds at most `maxsize` items, discarding the
+    least-recently-used item first.
+
+    >>> c = _LRUCache(maxsize=2)
+    >>> c["a"] = 1
+    >>> c["b"] = 2
+    >>> c.get("a")
+    1
+    >>> c["c"] = 3
+    >>> c.get("b") is None, c.get("a"), c.get("c")
+    (True, 1, 3)
+    >>> len(c)
+    2
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > max(0, self.maxsize):
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+_template_cache = _LRUCache(maxsize=20)
+
+
+def _load_template(image):
+    """Returns a `Template` for `image` (a filename, numpy array, or
+    `Template`).
+
+    Templates loaded from disk are cached for the lifetime of the process, so
+    that searching for the same image repeatedly doesn't re-read the png file
+    and re-build its pyramid every time. The cache is keyed on the file's
+    modification time, so changes to the file on disk are still noticed.
+    """
+    if isinstance(image, Template):
+        return image
+    if isinstance(image, numpy.ndarray):
+        return Template(image)
+
+    levels = get_config("match", "pyramid_levels", type_=int)
+    path = _find_path(image)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        raise UITestError("No such template file: %s" % image)
+    key = (path, mtime, levels)
+    template = _template_cache.get(key)
+    if template is None:
+        template = Template(path, pyramid_levels=levels)
+        _template_cache[key] = template
+    return template
+
+
 def _build_pyramid(image, levels):
     """A "pyramid" is [an image, the same image at 1/2 the size, at 1/4, ...]
 
@@ -1922,6 +3625,17 @@ class _Rect(namedtuple("_Rect", "x y w h")):
     def shift(self, position):
         return _Rect(self.x + position.x, self.y + position.y, self.w, self.h)
 
+    def overlaps(self, other):
+        return (self.x < other.x + other.w and other.x < self.x + self.w and
+                self.y < other.y + other.h and other.y < self.y + self.h)
+
+    def union(self, other):
+        """The smallest rectangle that contains both rectangles."""
+        x, y = min(self.x, other.x), min(self.y, other.y)
+        return _Rect(x, y,
+                     max(self.x + self.w, other.x + other.w) - x,
+                     max(self.y + self.h, other.y + other.h) - y)
+
     def to_slice(self):
         """Return a 2-dimensional slice suitable for indexing a numpy array."""
         return (slice(self.y, self.y + self.h), slice(self.x, self.x + self.w))
@@ -1946,17 +3660,21 @@ def _confirm_match(image, position, template, match_parameters):
 
     # Set Region Of Interest to the "best match" location
     roi = image[
-        position.y:(position.y + template.shape[0]),
-        position.x:(position.x + template.shape[1])]
-    image_gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
-    template_gray = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+        position.y:(position.y + template.height),
+        position.x:(position.x + template.width)]
+    if len(roi.shape) == 2:
+        # Copy because we normalize it in-place below.
+        image_gray = roi.copy()
+    else:
+        image_gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+    template_gray = template.gray
     log(roi, "confirm-source_roi")
     log(image_gray, "confirm-source_roi_gray")
     log(template_gray, "confirm-template_gray")
 
     if match_parameters.confirm_method == "normed-absdiff":
         cv2.normalize(image_gray, image_gray, 0, 255, cv2.NORM_MINMAX)
-        cv2.normalize(template_gray, template_gray, 0, 255, cv2.NORM_MINMAX)
+        template_gray = template.gray_normalized
         log(image_gray, "confirm-source_roi_gray_normalized")
         log(template_gray, "confirm-template_gray_normalized")
 
@@ -1975,6 +3693,159 @@ def _confirm_match(image, position, template, match_parameters):
     return cv2.countNonZero(eroded) == 0
 
 
+class _MotionDetector(object):
+    """Finds the areas of each video frame that have changed ("motion") since
+    the previous frame given to `detect`.
+
+    As a performance optimisation the frames are compared as grayscale images
+    downscaled by `scale` (`motion.scale` in stbt.conf). The mask is scaled
+    once, and the buffers for the intermediate images are allocated for the
+    first frame and re-used for every frame after that.
+
+    If `regions` are given, only those regions of the frame are searched for
+    motion (as if `mask` were white in those regions and black elsewhere); use
+    `region_motion` to find out which regions had motion.
+    """
+
+    def __init__(self, noise_threshold, mask=None, scale=None, regions=None):
+        if scale is None:
+            scale = get_config("motion", "scale", type_=float)
+        if not 0 < scale <= 1:
+            raise ConfigurationError(
+                "'motion.scale' must be greater than 0 and at most 1")
+        self.noise_threshold = noise_threshold
+        self.scale = scale
+        self.mask = mask
+        self.mask_image = _load_mask(mask) if mask else None
+        self.regions = regions
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+        self.started = False
+        self.thresholded = None
+        self._frame_shape = None
+        self._size = None
+        self._small = None
+        self._previous = None
+        self._current = None
+        self._absdiff = None
+        self._eroded = None
+        self._dilated = None
+        self._highlight_mask = None
+        self._log = functools.partial(
+            _log_image, directory="stbt-debug/detect_motion")
+
+    def _start(self, frame):
+        if (self.mask_image is not None and
+                self.mask_image.shape[:2] != frame.shape[:2]):
+            raise UITestError(
+                "The dimensions of the mask '%s' %s don't match the video "
+                "frame %s" % (self.mask, self.mask_image.shape,
+                              frame.shape[:2]))
+        self._frame_shape = frame.shape
+        height, width = frame.shape[:2]
+        if self.regions is not None:
+            self.regions = [_clip_region(r, frame) for r in self.regions]
+            regions_mask = numpy.zeros((height, width), dtype=numpy.uint8)
+            for r in self.regions:
+                regions_mask[r.to_slice()] = 255
+            if self.mask_image is not None:
+                cv2.bitwise_and(
+                    self.mask_image, regions_mask, dst=regions_mask)
+            self.mask_image = regions_mask
+        self._size = (max(1, int(width * self.scale)),
+                      max(1, int(height * self.scale)))
+        if self.scale != 1:
+            self._small = numpy.empty(
+                (self._size[1], self._size[0], 3), dtype=numpy.uint8)
+            if self.mask_image is not None:
+                self.mask_image = cv2.resize(
+                    self.mask_image, self._size,
+                    interpolation=cv2.INTER_NEAREST)
+        gray = (self._size[1], self._size[0])
+        self._previous = numpy.empty(gray, dtype=numpy.uint8)
+        self._current = numpy.empty(gray, dtype=numpy.uint8)
+        self._absdiff = numpy.empty(gray, dtype=numpy.uint8)
+        self.thresholded = numpy.empty(gray, dtype=numpy.uint8)
+        self._eroded = numpy.empty(gray, dtype=numpy.uint8)
+
+    def detect(self, frame):
+        """Returns a binary image (at the downscaled resolution) where the
+        white pixels are the areas that have changed since the previous
+        frame, or None for the first frame.
+
+        The returned image is only valid until the next call to `detect`.
+        """
+        if self._frame_shape is None:
+            self._start(frame)
+        if frame.shape != self._frame_shape:
+            raise UITestError(
+                "Video frame dimensions changed from %s to %s" % (
+                    self._frame_shape, frame.shape))
+
+        if self.scale != 1:
+            cv2.resize(frame, self._size, dst=self._small,
+                       interpolation=cv2.INTER_AREA)
+            frame = self._small
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._current)
+        self._log(self._current, "source")
+
+        self._previous, self._current = self._current, self._previous
+        if not self.started:
+            self.started = True
+            return None
+
+        absdiff = cv2.absdiff(self._previous, self._current, dst=self._absdiff)
+        self._log(absdiff, "absdiff")
+
+        if self.mask_image is not None:
+            cv2.bitwise_and(absdiff, self.mask_image, dst=absdiff)
+            self._log(self.mask_image, "mask")
+            self._log(absdiff, "absdiff_masked")
+
+        cv2.threshold(
+            absdiff, int((1 - self.noise_threshold) * 255), 255,
+            cv2.THRESH_BINARY, dst=self.thresholded)
+        eroded = cv2.erode(self.thresholded, self.kernel, dst=self._eroded)
+        self._log(self.thresholded, "absdiff_threshold")
+        self._log(eroded, "absdiff_threshold_erode")
+        return eroded
+
+    def region_motion(self, motion_mask, region):
+        """Returns a `RegionMotion` describing the motion within `region` (in
+        full-size frame coordinates) of the `motion_mask` returned by
+        `detect`.
+        """
+        x, y = int(region.x * self.scale), int(region.y * self.scale)
+        right = max(x + 1, int(math.ceil(region.right * self.scale)))
+        bottom = max(y + 1, int(math.ceil(region.bottom * self.scale)))
+        roi = motion_mask[y:bottom, x:right]
+        changed = cv2.countNonZero(roi)
+        if changed == 0:
+            return RegionMotion(region, False, 0, None)
+        ys, xs = numpy.nonzero(roi)
+        bounding_box = _intersect_regions(region, Region.from_extents(
+            int((x + xs.min()) / self.scale),
+            int((y + ys.min()) / self.scale),
+            int(math.ceil((x + xs.max() + 1) / self.scale)),
+            int(math.ceil((y + ys.max() + 1) / self.scale))))
+        return RegionMotion(
+            region, True, int(round(changed / self.scale ** 2)),
+            bounding_box or region)
+
+    def highlight(self, frame):
+        """Visualisation: Highlight in red the areas of `frame` where the last
+        call to `detect` found motion. For use with `Display.draw_overlay`.
+        """
+        self._dilated = cv2.dilate(
+            self.thresholded, self.kernel, dst=self._dilated, iterations=1)
+        mask = self._dilated
+        if self.scale != 1:
+            self._highlight_mask = cv2.resize(
+                mask, (frame.shape[1], frame.shape[0]),
+                dst=self._highlight_mask, interpolation=cv2.INTER_NEAREST)
+            mask = self._highlight_mask
+        cv2.add(frame, (0, 0, 255, 0), mask=mask, dst=frame)  # bgr
+
+
 _frame_number = 0
 
 
@@ -1985,18 +3856,196 @@ def _log_image(image, name, directory):
     if name == "source":
         _frame_number += 1
     d = os.path.join(directory, "%05d" % _frame_number)
-    if not _mkdir(d):
-        warn("Failed to create directory '%s'; won't save debug images." % d)
-        return
-    if image.dtype == numpy.float32:
-        image = cv2.convertScaleAbs(image, alpha=255)
-    cv2.imwrite(os.path.join(d, name) + ".png", image)
+    _get_debug_image_writer().write_image(
+        image, d, name, new_frame=(name == "source"))
+
+
+class _DebugImageWriter(object):
+    """Writes the stbt-debug images (at debug level 2, i.e. `-vv`) from a
+    background thread, so that writing them doesn't slow down (and change the
+    timing of) the image processing that we're trying to debug.
+
+    Images are copied and queued, using at most `max_bytes` bytes of memory
+    for the queued images. If the writer falls behind, `drop_policy` decides
+    what happens: "block" waits for space in the queue (so every image is
+    written); "drop" discards the rest of the current frame's debug images
+    (the images logged between one "source" image and the next) and counts
+    the frame in `frames_dropped`.
+
+    The writer also keeps an in-memory record of the images logged to each
+    directory, so that `flush` can write the html guide to the images
+    without listing the directories.
+    """
+
+    def __init__(self, max_bytes, drop_policy, png_compression):
+        if drop_policy not in ("block", "drop"):
+            raise ConfigurationError(
+                "Invalid debug.image_drop_policy '%s' (must be 'block' or "
+                "'drop')" % drop_policy)
+        self.queue = Queue.Queue()
+        self.max_bytes = max_bytes
+        self.queued_bytes = 0
+        self._space = threading.Condition()
+        self.drop_policy = drop_policy
+        self.png_compression = png_compression
+        self.images_written = 0
+        self.frames_dropped = 0
+        self._dropping = False
+        self._logged = OrderedDict()  # directory -> names of images logged
+        self._descriptions = []  # (directory, names, description)
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def write_image(self, image, directory, name, new_frame=False):
+        if new_frame:
+            self._dropping = False
+        if self._dropping:
+            return
+        with self._space:
+            # We always allow one image, however big, into an empty queue.
+            while (self.queued_bytes > 0 and
+                   self.queued_bytes + image.nbytes > self.max_bytes):
+                if self.drop_policy == "drop":
+                    self._dropping = True
+                    self.frames_dropped += 1
+                    ddebug("stbt-debug: Writer is behind; dropping the rest "
+                           "of %s" % directory)
+                    return
+                self._space.wait()
+            self.queued_bytes += image.nbytes
+        self._logged.setdefault(directory, []).append(name)
+        self.queue.put(
+            (image.nbytes, self._write_image, (image.copy(), directory, name)))
+
+    def describe(self, directory, **description):
+        """Record a description of the images logged to `directory`, for the
+        html guide written by `flush`.
+        """
+        if not self._dropping:
+            self._descriptions.append(
+                (directory, self._logged.get(directory, []), description))
+
+    def flush(self):
+        self.queue.join()
+        if self._descriptions:
+            _debug_html_index.extend(self._descriptions)
+            _write_image_descriptions(self._descriptions)
+        self._descriptions = []
+        self._logged.clear()
+        debug("stbt-debug: Wrote %d images; dropped %d frames" % (
+            self.images_written, self.frames_dropped))
+
+    def _write_image(self, image, directory, name):
+        if not _mkdir(directory):
+            warn("Failed to create directory '%s'; won't save debug images."
+                 % directory)
+            return
+        if image.dtype == numpy.float32:
+            image = cv2.convertScaleAbs(image, alpha=255)
+        cv2.imwrite(os.path.join(directory, name) + ".png", image,
+                    [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression])
+        self.images_written += 1
+
+    def _run(self):
+        while True:
+            nbytes, function, args = self.queue.get()
+            try:
+                function(*args)
+            except Exception as e:  # pylint: disable=W0703
+                warn("stbt-debug: Failed to write debug output: %s" % e)
+            finally:
+                with self._space:
+                    self.queued_bytes -= nbytes
+                    self._space.notify_all()
+                self.queue.task_done()
+
+
+_debug_image_writer = None
+
+
+def _get_debug_image_writer():
+    global _debug_image_writer
+    if _debug_image_writer is None:
+        _debug_image_writer = _DebugImageWriter(
+            max_bytes=get_config(
+                "debug", "image_queue_max_mb", type_=int) * 1024 * 1024,
+            drop_policy=get_config("debug", "image_drop_policy"),
+            png_compression=get_config("debug", "png_compression", type_=int))
+        atexit.register(_flush_debug_images)
+    return _debug_image_writer
+
+
+def _flush_debug_images():
+    """Wait for the background writer to finish writing the debug images."""
+    if _debug_image_writer is not None:
+        _debug_image_writer.flush()
 
 
 def _log_image_descriptions(
         template_name, matched, position,
         first_pass_matched, first_pass_certainty, match_parameters):
-    """Create html file that describes the debug images."""
+    """Record the description of the debug images for the html guide, which
+    is written when the debug images are flushed (see `_DebugImageWriter`).
+    """
+    d = os.path.join("stbt-debug/detect_match", "%05d" % _frame_number)
+    _get_debug_image_writer().describe(
+        d, template_name=template_name, matched=matched, position=position,
+        first_pass_matched=first_pass_matched,
+        first_pass_certainty=first_pass_certainty,
+        match_parameters=match_parameters)
+
+
+def _write_image_descriptions(frames):
+    """Write the html guide to the detect_match debug images: An index.html in
+    each frame's directory describing the images there, and a top-level
+    index.html listing all the frames.
+
+    `frames` is a list of `(directory, names, description)`, where `names` are
+    the debug images that were logged to `directory`, and `description` is
+    the dict of parameters given to `_log_image_descriptions`.
+    """
+    templates = _debug_html_templates()
+    if templates is None:
+        return
+    frame_template, index_template = templates
+
+    for d, names, description in frames:
+        if not os.path.isdir(d):
+            continue
+        levels = sorted(set(
+            int(m.group(1)) for m in (
+                re.match(r"level(\d+)-", name) for name in names) if m),
+            reverse=True)
+        with open(os.path.join(d, "index.html"), "w") as f:
+            f.write(frame_template.render(
+                levels=levels,
+                link=lambda s, level=None: (
+                    "<a href='{0}{1}.png'><img src='{0}{1}.png'></a>"
+                    .format("" if level is None else "level%d-" % level, s)),
+                min=min,
+                **description))
+
+    index = os.path.join("stbt-debug/detect_match", "index.html")
+    if os.path.isdir(os.path.dirname(index)):
+        with open(index, "w") as f:
+            f.write(index_template.render(frames=[
+                (os.path.basename(d), description)
+                for d, _, description in _debug_html_index]))
+
+
+# The frames listed in the top-level index.html of the detect_match debug
+# images: Grows as `_write_image_descriptions` is called for more frames.
+_debug_html_index = []
+_debug_html_templates_cache = []
+
+
+def _debug_html_templates():
+    """The jinja2 templates for `_write_image_descriptions`, compiled once.
+    Returns None if jinja2 isn't installed.
+    """
+    if _debug_html_templates_cache:
+        return _debug_html_templates_cache[0]
 
     try:
         import jinja2
@@ -2004,11 +4053,10 @@ def _log_image_descriptions(
         warn(
             "Not generating html guide to the image-processing debug images, "
             "because python 'jinja2' module is not installed.")
-        return
-
-    d = os.path.join("stbt-debug/detect_match", "%05d" % _frame_number)
+        _debug_html_templates_cache.append(None)
+        return None
 
-    template = jinja2.Template("""
+    frame_template = jinja2.Template("""
         <!DOCTYPE html>
         <html lang='en'>
         <head>
@@ -2099,22 +4147,32 @@ def _log_image_descriptions(
         </html>
     """)
 
-    with open(os.path.join(d, "index.html"), "w") as f:
-        f.write(template.render(
-            first_pass_certainty=first_pass_certainty,
-            first_pass_matched=first_pass_matched,
-            levels=list(reversed(sorted(set(
-                [int(re.search(r"level(\d+)-.*", x).group(1))
-                 for x in glob.glob(os.path.join(d, "level*"))])))),
-            link=lambda s, level=None: (
-                "<a href='{0}{1}.png'><img src='{0}{1}.png'></a>"
-                .format("" if level is None else "level%d-" % level, s)),
-            match_parameters=match_parameters,
-            matched=matched,
-            min=min,
-            position=position,
-            template_name=template_name,
-        ))
+    index_template = jinja2.Template("""
+        <!DOCTYPE html>
+        <html lang='en'>
+        <head>
+        <link href="http://netdna.bootstrapcdn.com/twitter-bootstrap/2.3.2/css/bootstrap-combined.min.css" rel="stylesheet">
+        </head>
+        <body>
+        <div class="container">
+        <h4>detect_match debug images</h4>
+        <table class="table table-condensed">
+        {% for frame, description in frames %}
+            <tr class="{{"success" if description.matched else ""}}">
+                <td><a href="{{frame}}/index.html">{{frame}}</a>
+                <td><i>{{description.template_name}}</i>
+                <td>{{"matched" if description.matched else "didn't match"}}
+                <td>{{"%.4f"|format(description.first_pass_certainty)}}
+            </tr>
+        {% endfor %}
+        </table>
+        </div>
+        </body>
+        </html>
+    """)
+
+    _debug_html_templates_cache.append((frame_template, index_template))
+    return _debug_html_templates_cache[0]
 
 
 def uri_to_remote(uri, display):
@@ -2587,15 +4645,18 @@ def _find_path(image):
     if os.path.isabs(image):
         return image
 
-    # stack()[0] is _find_path;
-    # stack()[1] is _find_path's caller, e.g. detect_match;
-    # stack()[2] is detect_match's caller (the user script).
-    for caller in inspect.stack()[2:]:
+    # Walk the frames directly rather than using `inspect.stack()`, which
+    # reads the source code of every frame in the stack from disk.
+    # currentframe() is _find_path;
+    # f_back is _find_path's caller, e.g. detect_match;
+    # f_back.f_back is detect_match's caller (the user script).
+    caller = inspect.currentframe().f_back.f_back
+    while caller is not None:
         caller_image = os.path.join(
-            os.path.dirname(inspect.getframeinfo(caller[0]).filename),
-            image)
+            os.path.dirname(caller.f_code.co_filename), image)
         if os.path.isfile(caller_image):
             return os.path.abspath(caller_image)
+        caller = caller.f_back
 
     # Fall back to image from cwd, for convenience of the selftests
     return os.path.abspath(image)
@@ -2847,7 +4908,12 @@ def test_wait_for_motion_half_motion_int():
 @contextmanager
 def _fake_frames_at_half_motion():
     class FakeDisplay(object):
-        def gst_samples(self, _timeout_secs=10):
+        frame_dedup = _FrameDeduplicator(enabled=False)
+
+        def draw_overlay(self, _draw):
+            pass
+
+        def gst_samples(self, _timeout_secs=10, **_kwargs):
             data = [
                 numpy.zeros((2, 2, 3), dtype=numpy.uint8),
                 numpy.ones((2, 2, 3), dtype=numpy.uint8) * 255,
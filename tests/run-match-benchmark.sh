@@ -0,0 +1,46 @@
+#!/bin/bash
+
+# Measures the speed of stbt's template matching with different values of
+# `match.threads`, to show the speed-up from using several CPU cores.
+#
+# Usage: run-match-benchmark.sh [threads...]
+#
+# The default is to try 1, 2, 4, ... up to the number of CPU cores. Uses a
+# 1080p frame made by scaling up "videotestsrc-full-frame.png", so you don't
+# need a video-capture device.
+
+cd "$(dirname "$0")"
+export PYTHONPATH="$PWD/..:$PYTHONPATH"
+
+cores=$(getconf _NPROCESSORS_ONLN)
+if [[ $# -gt 0 ]]; then
+    threads="$*"
+else
+    threads=""
+    for ((n = 1; n < cores; n *= 2)); do threads="$threads $n"; done
+    threads="$threads $cores"
+fi
+
+cat > benchmark.$$.py <<-'EOF'
+	import sys, timeit
+	import cv2
+	import stbt
+	frame = cv2.resize(cv2.imread("videotestsrc-full-frame.png"), (1920, 1080))
+	templates = [stbt.Template(frame[y:y + 120, x:x + 160])
+	             for x, y in [(200, 100), (1000, 500), (1600, 900)]]
+	mp = stbt.MatchParameters()
+	def run():
+	    for t in templates:
+	        stbt._match(frame, t, mp, t.name)
+	n = 10
+	duration = min(timeit.repeat(run, repeat=3, number=n))
+	print "%s threads: %.1f ms per frame (%d templates)" % (
+	    sys.argv[1], duration * 1000. / n, len(templates))
+	EOF
+trap "rm -f benchmark.$$.py benchmark.$$.conf" EXIT
+
+echo "$cores CPU cores"
+for n in $threads; do
+    printf "[match]\nthreads = %s\n" "$n" > benchmark.$$.conf
+    STBT_CONFIG_FILE="$PWD/benchmark.$$.conf" python benchmark.$$.py "$n"
+done
@@ -47,6 +47,37 @@ test_wait_for_match_opencv_image_can_be_used_as_template() {
     stbt run -v --control none test.py
 }
 
+test_wait_for_match_template_object_can_be_used_as_template() {
+    cat > test.py <<-EOF &&
+	import stbt
+	template = stbt.Template("$testdir/videotestsrc-redblue.png")
+	for _ in range(3):
+	    m = stbt.wait_for_match(template)
+	    assert m.image is template
+	stbt.wait_for_match(stbt.Template(
+	    "$testdir/videotestsrc-redblue.png", pyramid_levels=1))
+	EOF
+
+    stbt run -v --control none test.py
+}
+
+test_that_template_cache_notices_changes_to_the_template_file() {
+    cat > test.py <<-EOF &&
+	import os, shutil, stbt
+	shutil.copy("$testdir/videotestsrc-redblue.png", "template.png")
+	stbt.wait_for_match("template.png")
+	shutil.copy("$testdir/videotestsrc-redblue-flipped.png", "template.png")
+	os.utime("template.png", (0, 0))
+	try:
+	    stbt.wait_for_match("template.png", timeout_secs=1)
+	    assert False, "Matched stale cached template"
+	except stbt.MatchTimeout:
+	    pass
+	EOF
+
+    stbt run -v --control none test.py
+}
+
 test_wait_for_match_noise_threshold_raises_warning() {
     cat > test.py <<-EOF
 	wait_for_match(
@@ -185,6 +216,37 @@ test_wait_for_match_with_pyramid_optimisation_disabled() {
     stbt run -v test.py
 }
 
+test_wait_for_match_with_multiple_threads() {
+    cat > test.py <<-EOF &&
+	import stbt
+	stbt.wait_for_match("$testdir/videotestsrc-redblue.png")
+	results = stbt.detect_matches(
+	    ["$testdir/videotestsrc-checkers-8.png",
+	     "$testdir/videotestsrc-redblue.png",
+	     "$testdir/videotestsrc-bw.png"]).next()
+	assert [bool(m) for m in results] == [False, True, True], results
+	EOF
+    set_config match.threads "4" &&
+    stbt run -v test.py
+}
+
+test_wait_for_match_in_grayscale() {
+    cat > test.py <<-EOF &&
+	import stbt
+	m = stbt.wait_for_match(
+	    "$testdir/videotestsrc-redblue.png",
+	    match_parameters=stbt.MatchParameters(colour=False))
+	assert m.region == stbt.Region(228, 0, 92, 160), m.region
+	results = stbt.detect_matches(
+	    ["$testdir/videotestsrc-redblue.png",
+	     "$testdir/videotestsrc-bw.png"],
+	    match_parameters=[stbt.MatchParameters(colour=False),
+	                      stbt.MatchParameters(colour=True)]).next()
+	assert all(results), results
+	EOF
+    stbt run -v test.py
+}
+
 test_detect_match_nonexistent_template() {
     cat > test.py <<-EOF
 	try:
@@ -357,6 +419,23 @@ test_detect_match_reports_match_region() {
     stbt run -v test.py
 }
 
+test_detect_match_with_region_reports_match_region_in_frame_coordinates() {
+    cat > test.py <<-EOF
+	from stbt import detect_match, wait_for_match, MatchTimeout, Region
+	m = detect_match("$testdir/videotestsrc-redblue.png",
+	                 region=Region(200, 0, 120, 200)).next()
+	assert m.match
+	assert m.region == Region(228, 0, 92, 160), str(m.region)
+	try:
+	    wait_for_match("$testdir/videotestsrc-redblue.png",
+	                   region=Region(0, 0, 200, 240), timeout_secs=1)
+	    assert False, "Matched outside of the specified region"
+	except MatchTimeout:
+	    pass
+	EOF
+    stbt run -v test.py
+}
+
 test_detect_match_reports_valid_timestamp() {
     cat > test.py <<-EOF
 	last_timestamp=None
@@ -391,6 +470,69 @@ test_detect_match_reports_no_match() {
     stbt run -v test.py
 }
 
+test_detect_matches_reports_a_result_for_each_template() {
+    cat > test.py <<-EOF
+	import stbt
+	images = ["$testdir/videotestsrc-checkers-8.png",
+	          "$testdir/videotestsrc-redblue.png",
+	          "$testdir/videotestsrc-bw.png"]
+	results = stbt.detect_matches(images).next()
+	assert [bool(m) for m in results] == [False, True, True], results
+	assert [m.image for m in results] == images
+	assert len(set(m.timestamp for m in results)) == 1
+	EOF
+    stbt run -v test.py
+}
+
+test_wait_for_any_match() {
+    cat > test.py <<-EOF
+	import stbt
+	m = stbt.wait_for_any_match(
+	    ["$testdir/videotestsrc-checkers-8.png",
+	     "$testdir/videotestsrc-redblue.png"],
+	    match_parameters=[stbt.MatchParameters(), stbt.MatchParameters()])
+	assert m.image == "$testdir/videotestsrc-redblue.png"
+	try:
+	    stbt.wait_for_any_match(
+	        ["$testdir/videotestsrc-checkers-8.png",
+	         "$testdir/videotestsrc-redblue-flipped.png"], timeout_secs=1)
+	    assert False, "wait_for_any_match should have timed out"
+	except stbt.MatchTimeout:
+	    pass
+	EOF
+    stbt run -v test.py
+}
+
+test_wait_for_match_with_tracking() {
+    cat > test.py <<-EOF
+	import stbt
+	m = stbt.wait_for_match("$testdir/videotestsrc-redblue.png",
+	                        consecutive_matches=10, tracking=True)
+	assert m.region == stbt.Region(228, 0, 92, 160), m.region
+	EOF
+    stbt run -vv test.py &&
+    grep -q "Tracking .*videotestsrc-redblue.png: found" log
+}
+
+test_wait_for_match_with_frame_dedup() {
+    set_config global.frame_dedup "True" &&
+    cat > test.py <<-EOF &&
+	wait_for_match("$testdir/videotestsrc-redblue.png", consecutive_matches=10)
+	EOF
+    stbt run -vv --source-pipeline="videotestsrc ! imagefreeze" test.py &&
+    grep -q "Frame unchanged; re-using previous result" log &&
+
+    # Results that didn't match are re-used too:
+    cat > test.py <<-EOF &&
+	wait_for_match("$testdir/videotestsrc-redblue.png", timeout_secs=2)
+	EOF
+    ! stbt run -vv \
+        --source-pipeline="videotestsrc pattern=black ! imagefreeze" \
+        test.py &&
+    grep -q "Frame unchanged; re-using previous result" log &&
+    grep -q "teardown: Frame deduplication re-used results for [1-9]" log
+}
+
 test_detect_match_times_out() {
     cat > test.py <<-EOF
 	for match_result in detect_match("$testdir/videotestsrc-redblue.png",
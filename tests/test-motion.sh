@@ -28,6 +28,39 @@ test_wait_for_motion_no_motion_str() {
     ! stbt run -v --source-pipeline="videotestsrc ! imagefreeze" test.py
 }
 
+test_wait_for_motion_with_frame_dedup() {
+    cat > test.py <<-EOF &&
+	wait_for_motion(consecutive_frames=10)
+	EOF
+    set_config global.frame_dedup "True" &&
+    stbt run -v test.py
+}
+
+test_wait_for_motion_with_frame_dedup_skips_unchanged_frames() {
+    cat > test.py <<-EOF &&
+	wait_for_motion(consecutive_frames=10, timeout_secs=1)
+	EOF
+    set_config global.frame_dedup "True" &&
+    ! stbt run -vv --source-pipeline="videotestsrc ! imagefreeze" test.py &&
+    grep -q "Frame unchanged; re-using previous result" log
+}
+
+test_wait_for_motion_with_downscaled_frames() {
+    cat > test.py <<-EOF &&
+	wait_for_motion(consecutive_frames=10)
+	EOF
+    set_config motion.scale "0.5" &&
+    stbt run -v test.py &&
+    cat > test.py <<-EOF &&
+	wait_for_motion(consecutive_frames=10, timeout_secs=1)
+	EOF
+    ! stbt run -v --source-pipeline="videotestsrc ! imagefreeze" test.py &&
+    cat > test.py <<-EOF &&
+	wait_for_motion(mask="$testdir/videotestsrc-mask-video.png")
+	EOF
+    stbt run -v test.py
+}
+
 test_wait_for_motion_with_mask_reports_motion() {
     cat > test.py <<-EOF
 	wait_for_motion(mask="$testdir/videotestsrc-mask-video.png")
@@ -117,6 +150,45 @@ test_detect_motion_reports_no_motion() {
     stbt run -v test.py
 }
 
+test_detect_motion_regions_reports_which_regions_moved() {
+    cat > test.py <<-EOF
+	import stbt
+	noise = stbt.Region(240, 180, 80, 60)  # videotestsrc's animated "snow"
+	static = stbt.Region(0, 0, 100, 100)
+	for result in stbt.detect_motion_regions([noise, static]):
+	    if result.motion:
+	        assert [r.motion for r in result.regions] == [True, False]
+	        assert result.regions[0].changed_pixels > 0
+	        assert noise.contains(result.regions[0].bounding_box)
+	        assert result.regions[1] == (static, False, 0, None)
+	        break
+	else:
+	    assert False, "detect_motion_regions didn't report motion"
+	EOF
+    stbt run -v test.py
+}
+
+test_wait_for_stable() {
+    cat > test.py <<-EOF &&
+	import stbt
+	result = stbt.wait_for_stable(stable_secs=1)
+	assert result.settle_secs == 0, result
+	EOF
+    stbt run -v --source-pipeline="videotestsrc ! imagefreeze" test.py &&
+    cat > test.py <<-EOF &&
+	import stbt
+	try:
+	    stbt.wait_for_stable(timeout_secs=2, stable_secs=1)
+	    assert False, "wait_for_stable should have timed out"
+	except stbt.StableTimeout:
+	    pass
+	stbt.wait_for_stable(
+	    timeout_secs=2, stable_secs=1,
+	    mask="$testdir/videotestsrc-mask-no-video.png")
+	EOF
+    stbt run -v test.py
+}
+
 test_detect_motion_times_out() {
     cat > test.py <<-EOF
 	for motion_result in detect_motion(timeout_secs=1):
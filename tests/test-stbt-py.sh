@@ -261,6 +261,180 @@ test_save_video() {
         test.py
 }
 
+test_save_video_passthrough() {
+    cat > record.py <<-EOF &&
+	import time
+	time.sleep(2)
+	EOF
+    set_config run.save_video "video.mkv" &&
+    set_config run.save_video_mode "passthrough" &&
+    set_config run.passthrough_mux "matroskamux" &&
+    stbt run -v --source-pipeline 'videotestsrc is-live=true ! vp8enc' \
+        record.py &&
+    ! grep -q "vp8enc cpu-used" log &&
+    cat > test.py <<-EOF &&
+	wait_for_match("$testdir/videotestsrc-redblue.png")
+	EOF
+    set_config run.save_video "" &&
+    timeout 10 stbt run -v --control none \
+        --source-pipeline 'filesrc location=video.mkv' \
+        test.py
+}
+
+test_flight_recorder() {
+    cat > pass.py <<-EOF &&
+	import time
+	time.sleep(2)
+	EOF
+    cat > fail.py <<-EOF &&
+	import time
+	time.sleep(4)
+	assert False
+	EOF
+    set_config run.save_video "" &&
+    set_config run.flight_recorder_secs "2" &&
+    ! stbt run -v fail.py &> log &&
+    ! grep -q "flight recorder" log || fail "Used the flight recorder" &&
+    ! ls *.webm 2>/dev/null || fail "Saved video without --save-video" &&
+
+    set_config run.save_video "video.webm" &&
+    stbt run -v pass.py &&
+    [ ! -e video.webm ] || fail "Saved video for a passing test" &&
+    ! stbt run -v fail.py &&
+    [ -e video.webm ] || fail "Didn't save video for a failing test" &&
+
+    mkdir "My Tests" &&
+    set_config run.save_video "My Tests/it's a video.webm" &&
+    ! stbt run -v fail.py &&
+    [ -e "My Tests/it's a video.webm" ] || fail "Didn't save to 'My Tests'" &&
+
+    cat > test.py <<-EOF &&
+	wait_for_match("$testdir/videotestsrc-redblue.png")
+	EOF
+    set_config run.save_video "" &&
+    set_config run.flight_recorder_secs "0" &&
+    timeout 10 stbt run -v --control none \
+        --source-pipeline 'filesrc location=video.webm' \
+        test.py
+}
+
+test_frames_since() {
+    cat > test.py <<-EOF &&
+	import time
+	import stbt
+	_, start = next(stbt.frames())
+	time.sleep(2)
+	_, first = next(stbt.frames(since=start))
+	assert 0 < first - start < 0.5e9, "%d - %d" % (first, start)
+	EOF
+    ! stbt run -v test.py &&
+    set_config global.frame_history_secs "5" &&
+    stbt run -v test.py &&
+
+    # Frames keep arriving while we're catching up on the history, because
+    # we're slower than the source (25 frames per second):
+    cat > test.py <<-EOF &&
+	import time
+	import stbt
+	_, start = next(stbt.frames())
+	time.sleep(1)
+	timestamps = [start]
+	for _, t in stbt.frames(since=start):
+	    timestamps.append(t)
+	    time.sleep(0.06)
+	    if t - start > 3e9:
+	        break
+	intervals = [b - a for a, b in zip(timestamps, timestamps[1:])]
+	assert max(intervals) < 0.06e9, "Missed frames: %r" % intervals
+	EOF
+    stbt run -v --source-pipeline \
+        'videotestsrc is-live=true ! video/x-raw,framerate=25/1' test.py
+}
+
+test_frame_decimation() {
+    cat > test.py <<-EOF &&
+	import sys
+	import stbt
+	timestamps = [t for _, t in stbt.frames(
+	    timeout_secs=2, every_nth_frame=int(sys.argv[1]))]
+	intervals = [b - a for a, b in zip(timestamps, timestamps[1:])]
+	print intervals
+	assert len(intervals) > 4
+	assert min(intervals) >= float(sys.argv[2]) * 1e9
+	EOF
+    stbt run -v test.py 3 0.09 &&
+    ! stbt run -v test.py 1 0.09 &&
+    set_config global.analysis_fps "5" &&
+    stbt run -v test.py 1 0.15
+}
+
+test_frame_statistics_and_frame_policy() {
+    cat > test.py <<-EOF &&
+	import sys, time
+	import stbt
+	for i, _ in enumerate(stbt.frames()):
+	    time.sleep(0.2)
+	    if i == 10:
+	        break
+	stats = stbt.frame_statistics()
+	print stats
+	assert stats.analysed == 11
+	assert stats.received >= stats.analysed + stats.dropped
+	if sys.argv[1] == "latest":
+	    assert stats.dropped > 20
+	    assert stats.max_age_secs < 0.5
+	else:
+	    assert stats.dropped == 0
+	    assert stats.max_age_secs > 1
+	EOF
+    stbt run -v test.py latest &&
+    grep -q "teardown: FrameStatistics(" log &&
+    set_config global.frame_policy "in-order" &&
+    set_config global.frame_backlog "1000" &&
+    stbt run -v test.py in-order
+}
+
+test_save_video_passthrough_after_restarting_source() {
+    cat > record.py <<-EOF &&
+	import time
+	import stbt
+	time.sleep(1)
+	stbt._display.restart_source()
+	time.sleep(7)
+	EOF
+    set_config run.save_video "video.mkv" &&
+    set_config run.save_video_mode "passthrough" &&
+    set_config run.passthrough_mux "matroskamux" &&
+    stbt run -v --source-pipeline 'videotestsrc is-live=true ! vp8enc' \
+        record.py &&
+    [ -e video.mkv ] || fail "Didn't record before restarting the source" &&
+    [ -e video.1.mkv ] || fail "Didn't record after restarting the source" &&
+    cat > test.py <<-EOF &&
+	wait_for_match("$testdir/videotestsrc-redblue.png")
+	EOF
+    set_config run.save_video "" &&
+    timeout 10 stbt run -v --control none \
+        --source-pipeline 'filesrc location=video.1.mkv' \
+        test.py
+}
+
+test_headless() {
+    cat > test.py <<-EOF &&
+	import stbt
+	stbt.draw_text("Test", duration_secs=60)
+	stbt.wait_for_match("$testdir/videotestsrc-redblue.png")
+	stbt.wait_for_motion()
+	EOF
+    stbt run -v test.py &&
+    grep -q "Running headless" log &&
+    ! grep -q "sink pipeline:" log &&
+
+    set_config global.headless "False" &&
+    stbt run -v test.py &> test.log &&
+    ! grep -q "Running headless" test.log &&
+    grep -q "sink pipeline:" test.log
+}
+
 test_that_verbosity_level_is_read_from_config_file() {
     set_config global.verbose "2" &&
     touch test.py &&
@@ -21,6 +21,15 @@ test_that_stbt_templatematch_applies_confirm_threshold_parameter() {
         "$testdir"/videotestsrc-redblue-with-dots.png confirm_threshold=0.9
 }
 
+test_that_stbt_templatematch_matches_in_grayscale() {
+    stbt templatematch \
+        "$testdir"/videotestsrc-full-frame.png \
+        "$testdir"/videotestsrc-redblue.png colour=False &&
+    ! stbt templatematch \
+        "$testdir"/videotestsrc-full-frame.png \
+        "$testdir"/videotestsrc-gamut.png colour=False
+}
+
 test_that_stbt_templatematch_rejects_invalid_parameters() {
     ! stbt templatematch \
         idontexist.png \
@@ -42,3 +51,39 @@ test_that_stbt_templatematch_rejects_invalid_parameters() {
         confirm_threshold=five &&
     cat log | grep -q "Invalid argument 'confirm_threshold=five'"
 }
+
+test_that_stbt_templatematch_searches_in_region() {
+    stbt templatematch --region 200,0,120,240 \
+        "$testdir"/videotestsrc-full-frame.png \
+        "$testdir"/videotestsrc-redblue.png &&
+    ! stbt templatematch --region 0,0,200,240 \
+        "$testdir"/videotestsrc-full-frame.png \
+        "$testdir"/videotestsrc-redblue.png &&
+    ! stbt templatematch --region 0,0,junk \
+        "$testdir"/videotestsrc-full-frame.png \
+        "$testdir"/videotestsrc-redblue.png &&
+    cat log | grep -q "Invalid region '0,0,junk'"
+}
+
+test_that_stbt_templatematch_writes_debug_images() {
+    stbt templatematch -v \
+        "$testdir"/videotestsrc-full-frame.png \
+        "$testdir"/videotestsrc-redblue.png &&
+    [ -f stbt-debug/detect_match/00001/source.png ] &&
+    [ -f stbt-debug/detect_match/00001/confirm-absdiff.png ]
+}
+
+test_that_stbt_templatematch_writes_debug_html_guide() {
+    python -c "import jinja2" &>/dev/null || {
+        echo "jinja2 not found; skipping this test." >&2
+        return 77
+    }
+
+    stbt templatematch -v \
+        "$testdir"/videotestsrc-full-frame.png \
+        "$testdir"/videotestsrc-redblue.png &&
+    grep -q "matched" stbt-debug/detect_match/00001/index.html &&
+    grep -q "level0-source_matchtemplate.png" \
+        stbt-debug/detect_match/00001/index.html &&
+    grep -q "00001/index.html" stbt-debug/detect_match/index.html
+}
@@ -2,7 +2,9 @@
 
 import codecs
 import distutils
+import os
 import sys
+from contextlib import contextmanager
 from textwrap import dedent
 
 import cv2
@@ -97,3 +99,112 @@ def test_user_dictionary_with_non_english_language():
         mode=stbt.OcrMode.SINGLE_WORD,
         lang="deu",
         tesseract_user_words=[u'UJJM2LGE']))
+
+
+@contextmanager
+def _ocr_cache(maxsize):
+    # pylint: disable=W0212
+    orig, stbt._ocr_cache = stbt._ocr_cache, stbt._OcrCache(maxsize)
+    try:
+        yield stbt._ocr_cache
+    finally:
+        stbt._ocr_cache = orig
+
+
+def test_that_libtesseract_gives_the_same_text_as_the_tesseract_program():
+    # pylint: disable=W0212
+    try:
+        stbt._load_libtesseract()
+    except OSError:
+        raise SkipTest('libtesseract is not installed')
+
+    with _ocr_cache(maxsize=0):
+        for image, kwargs in [
+                ('tests/ocr/small.png', {}),
+                ('tests/ocr/ambig.png', {}),
+                ('tests/ocr/unicode.png', {'lang': 'eng+deu'}),
+                ('tests/ocr/UJJM2LGE.png', {
+                    'mode': stbt.OcrMode.SINGLE_WORD, 'lang': 'deu',
+                    'user_words': [u'UJJM2LGE']})]:
+            frame = cv2.imread(image)
+            eq_(stbt._tesseract(frame, engine='subprocess', **kwargs),
+                stbt._tesseract(frame, engine='library', **kwargs))
+
+
+def test_that_auto_engine_falls_back_to_the_program_if_the_library_fails():
+    # pylint: disable=W0212
+    class BrokenEngine(object):
+        def recognise(self, *_):
+            raise RuntimeError("libtesseract failed to recognise text")
+
+    frame = cv2.imread('tests/ocr/small.png')
+    orig = stbt._get_tesseract_engine
+    stbt._get_tesseract_engine = lambda *_: BrokenEngine()
+    try:
+        with _ocr_cache(maxsize=0):
+            eq_(stbt._tesseract(frame, engine='subprocess'),
+                stbt._tesseract(frame, engine='auto'))
+            assert stbt._libtesseract_failed
+            try:
+                stbt._tesseract(frame, engine='library')
+                assert False, "Expected RuntimeError"
+            except RuntimeError:
+                pass
+    finally:
+        stbt._get_tesseract_engine = orig
+        stbt._libtesseract_failed = False
+
+
+def test_that_ocr_results_are_cached():
+    frame = cv2.imread('tests/ocr/small.png')
+    with _ocr_cache(maxsize=10) as cache:
+        text = stbt.ocr(frame)
+        eq_((0, 1), (cache.hits, cache.misses))
+        eq_(text, stbt.ocr(frame))
+        eq_((1, 1), (cache.hits, cache.misses))
+        stbt.ocr(frame, mode=stbt.OcrMode.SINGLE_LINE)
+        stbt.ocr(frame, region=stbt.Region(0, 0, 100, 20))
+        eq_((1, 3), (cache.hits, cache.misses))
+
+
+def test_that_prepared_tessdata_is_reused_and_removed():
+    # pylint: disable=W0212
+    frame = cv2.imread('tests/ocr/UJJM2LGE.png')
+    stbt._remove_prepared_tessdata()  # Left over from previous tests
+    with _ocr_cache(maxsize=0):
+        for _ in range(2):
+            for engine in ['subprocess', 'auto']:
+                stbt._tesseract(frame, mode=stbt.OcrMode.SINGLE_WORD,
+                                user_words=[u'UJJM2LGE'], engine=engine)
+    eq_(1, len(stbt._prepared_tessdata_dirs))
+    prefix, _ = stbt._prepared_tessdata_dirs.values()[0]
+    assert os.path.isdir(prefix)
+    stbt._remove_prepared_tessdata()
+    assert not os.path.exists(prefix)
+    eq_(0, len(stbt._prepared_tessdata_dirs))
+
+
+def test_that_ocr_many_gives_the_same_text_as_ocr():
+    frame = cv2.imread('tests/ocr/ambig.png')
+    h, w = frame.shape[:2]
+    regions = [stbt.Region(0, y, w, h // 4) for y in range(0, h, h // 4)
+               if y + h // 4 <= h] + [None]
+    with _ocr_cache(maxsize=0):
+        eq_([stbt.ocr(frame, region=region) for region in regions],
+            stbt.ocr_many(frame, regions))
+
+
+def test_that_piping_to_tesseract_gives_the_same_text_as_using_files():
+    # pylint: disable=W0212
+    if stbt._tesseract_version() < distutils.version.LooseVersion('3.03'):
+        raise SkipTest('tesseract is too old')
+
+    for image in ['tests/ocr/small.png', 'tests/ocr/unicode.png']:
+        frame = cv2.imread(image)
+        with_files = stbt._tesseract_subprocess_with_files(
+            frame, stbt.OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD, 'eng+deu', [],
+            os.environ.copy())
+        with_pipes = stbt._tesseract_subprocess(
+            frame, stbt.OcrMode.PAGE_SEGMENTATION_WITHOUT_OSD, 'eng+deu', {},
+            None, None)
+        eq_(with_files, with_pipes)